@@ -1,7 +1,7 @@
 import numpy as np
 import numpy.ma as ma
-from functions import days2date
-from dateutil.relativedelta import relativedelta
+from functions import days2date, annual_means
+from profiling import stage
 import matplotlib.pyplot as plt
 from cartopy.feature import ShapelyFeature
 import cartopy.io.shapereader as shpreader
@@ -13,6 +13,7 @@ import cartopy.crs as ccrs
 #=======================================================
 
 # Load the output from dgw_calculation.py.
+# Load 'dgw_filled.npz' (dgw_gap_filling.py) instead to work with gap filled data.
 npzfile = np.load('dgw.npz')
 
 dgw_data = npzfile['dgw_filtered_data']
@@ -44,23 +45,11 @@ dev = ma.masked_array(dev_data, mask = dev_mask)
 
 # Calculate annual mean variations.
 
-# List of years.
-m = np.asarray([2002, 2003, 2004, 2005, 2006, 2007, 2008, 2009, 2010, 2011, 
-                2012, 2013, 2014, 2015, 2016])
-
-# Group the maps by year.
-# Shift the data in time in order to obtain years with July as first month.
-ind_year = [[] for i in range(len(m))]
-for i in range (len(m)):
-    for j in range(len(dates)):
-        if (dates[j] + relativedelta(months = 6)).year == m[i]:
-            ind_year[i].append(j)
+# List of years (2002-2016 for the original data).
+m = np.arange(dates[0].year, dates[-1].year + 1)
 
 # Average the groundwater variations for all periods July-June in 2002-2016.
-annual_map = np.zeros(shape = (len(m), 150, 360))
-annual_map = np.ma.masked_array(annual_map, mask = True)
-for i in range(len(m)):
-    annual_map[i] = np.ma.mean(dev[ind_year[i], :, :], axis = 0)
+annual_map = annual_means(dev, dates, m, shift = 6)
 
 
 #===================================================    
@@ -75,21 +64,16 @@ shp_provinces = shpreader.Reader('./shapefiles/provinces.shp')
 # Shapefile with the limits of the area of interest.
 shp_polygon = shpreader.Reader('./shapefiles/loess_holes.shp')
 
-titles = ['Jul 2002 - Jun 2003', 'Jul 2003 - Jun 2004',
-          'Jul 2004 - Jun 2005', 'Jul 2005 - Jun 2006',
-          'Jul 2006 - Jun 2007', 'Jul 2007 - Jun 2008', 
-          'Jul 2008 - Jun 2009', 'Jul 2009 - Jun 2010', 
-          'Jul 2010 - Jun 2011', 'Jul 2011 - Jun 2012', 
-          'Jul 2012 - Jun 2013', 'Jul 2013 - Jun 2014',
-          'Jul 2014 - Jun 2015', 'Jul 2015 - Jun 2016']
+titles = ['Jul {} - Jun {}'.format(year, year + 1) for year in m]
+
+# Maps from 2002 to 2010 -> plot_years = range(2002, 2010).
+# Maps from 2010 to 2016 -> plot_years = range(2010, 2016).
+plot_years = range(2010, 2016)
 
 fig = plt.figure(figsize = (13, 7))
 
-# Maps from 2002 to 2010 -> i from 0 to 8.
-# Maps from 2010 to 2016 -> i from 8 to 14.
-for i in range(8, 14):
-    # ax = plt.subplot(2, 4, i + 1, projection = ccrs.PlateCarree())
-    ax = plt.subplot(2, 4, (i + 1) - 8, projection = ccrs.PlateCarree())
+for k, i in enumerate(np.flatnonzero(np.isin(m, plot_years))):
+    ax = plt.subplot(2, 4, k + 1, projection = ccrs.PlateCarree())
     plot = ax.contourf(annual_map[i, :, :], 
                        transform = ccrs.PlateCarree(), cmap = 'rainbow_r', 
                        extent = [lon[0] - 360, lon[-1] - 360, lat[0], lat[-1]], 
@@ -127,5 +111,6 @@ cb.set_label('EWT [cm]', color = "black", size = 14)
 cb.ax.tick_params(labelsize = 14)
 
 # Save plot as a .png image.
-# plt.savefig('annual_mean_2002to2010.png', bbox_inches = 'tight')
-plt.savefig('annual_mean_2010to2016.png', bbox_inches = 'tight')
\ No newline at end of file
+with stage('render'):
+    plt.savefig('annual_mean_{}to{}.png'.format(plot_years[0], plot_years[-1] + 1), 
+                bbox_inches = 'tight')
\ No newline at end of file
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import numpy.ma as ma
+from netCDF4 import Dataset
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from cartopy.feature import ShapelyFeature
+import cartopy.io.shapereader as shpreader
+import cartopy.crs as ccrs
+import profiling
+from profiling import stage
+from functions import (days2date, matching_rows, reference_cell, grace_storage,
+                       load_components, assemble_storage, interpolate_models,
+                       groundwater_anomalies, filter_area, monthly_means, annual_means,
+                       to_calendar, fill_gaps, detect_events, idw_point, export_netcdf,
+                       export_chunks, read_series, read_map)
+from synthetic_data import (write_synthetic, gldas_file, gldas_variables, grace_files,
+                            factors_file)
+
+
+# Cases as resolution in degrees : length of the record in years.
+# 0.25 degrees needs several GB of memory.
+default_cases = ['1:15', '1:40', '0.5:15', '0.25:15']
+
+# A stage is a regression when it is slower (or uses more memory) than the
+# baseline by more than the tolerance and by more than these amounts.
+min_wall = 0.05  # [s]
+min_memory = 1  # [MB]
+
+
+def run_case(folder, n_points = 100, seed = 0):
+    """
+    Run every stage of the pipeline on a synthetic data set, with the 
+    functions called by the scripts, inside profiling stages.
+
+    Arguments:
+    folder -- Folder with the synthetic data set (write_synthetic).
+    n_points -- Number of point queries.
+    seed -- Seed of the random points.
+    """
+
+    data_folder = os.path.join(folder, 'data')
+    shapefiles = os.path.join(folder, 'shapefiles')
+    output = tempfile.mkdtemp()
+
+    try:
+        # dgw_calculation.py, with the same functions.
+        with stage('read'):
+            gldas_models = {'NOAH': {'file': os.path.join(data_folder, gldas_file),
+                                     'layers': {name: name for name in gldas_variables}}}
+            gldas_layers = load_components(gldas_models,
+                                           cache_dir = os.path.join(output, 'cache'))
+            gldas = Dataset(gldas_models['NOAH']['file'])
+            gldas_lat = gldas.variables['lat'][:]
+            gldas_time = gldas.variables['time'][:]
+
+            centers = [Dataset(os.path.join(data_folder, file))
+                       for file in grace_files.values()]
+            grace_lat = centers[0].variables['lat'][:]
+            grace_lon = centers[0].variables['lon'][:]
+            grace_time = centers[0].variables['time'][:]
+            factors = Dataset(os.path.join(data_folder, factors_file))
+            factors_data = factors.variables['SCALE_FACTOR'][:, :]
+
+            grace_ws = grace_storage([center.variables['lwe_thickness']
+                                      for center in centers], factors_data)
+            grace_ws = ma.array(grace_ws[:, matching_rows(grace_lat, gldas_lat), :])
+
+        with stage('assembly'):
+            gldas_ws = {'NOAH': assemble_storage(gldas_layers, ['CanopInt_inst',
+                                                                'SoilMoi0_10cm_inst',
+                                                                'SoilMoi10_40cm_inst'],
+                                                 ['NOAH'])}
+
+        ref_cell = reference_cell(gldas_lat, grace_lon)
+        grace_dates = days2date(grace_time, source = 'grace')
+        gldas_dates = {'NOAH': days2date(ma.getdata(gldas_time), source = 'gldas')}
+
+        with stage('interpolation'):
+            gldas_ws_interp = interpolate_models(grace_dates, gldas_dates, grace_ws,
+                                                 gldas_ws, ref_cell = ref_cell)
+
+        with stage('anomalies'):
+            dgw = groundwater_anomalies(grace_ws, gldas_ws_interp)
+
+        with stage('masking'):
+            dgw = filter_area(grace_lon, gldas_lat, dgw, grace_ws, ref_cell = ref_cell,
+                              shapefile = os.path.join(shapefiles, 'loess_holes.shp'))
+
+        # monthly_mean.py and annual_mean.py.
+        with stage('aggregation'):
+            monthly_map, dev = monthly_means(dgw, grace_dates)
+            years = np.arange(grace_dates[0].year, grace_dates[-1].year + 1)
+            annual_map = annual_means(dev, grace_dates, years)
+
+        with stage('events'):
+            detect_events(dev, threshold = 5)
+
+        # dgw_gap_filling.py.
+        with stage('gap_filling'):
+            months, positions, shifted, dgw_months = to_calendar(dgw, grace_dates)
+            fill_gaps(dgw_months, months)
+
+        # dgw_point.py and dgw_server.py, at points around the area of interest.
+        # Points next to cells without data are expected and skipped; any other
+        # error stops the benchmark.
+        rng = np.random.default_rng(seed)
+        points = zip(rng.uniform(-37, -27, n_points), rng.uniform(295, 302, n_points))
+        n_queries = 0
+        with stage('point_queries'):
+            for lat_point, lon_point in points:
+                try:
+                    idw_point(dgw, gldas_lat, grace_lon, lat_point, lon_point)
+                    n_queries += 1
+                except Exception as error:
+                    if str(error) != 'There is no data at the chosen point.':
+                        raise
+        if n_queries == 0:
+            raise Exception('No point query found data.')
+
+        with stage('export'):
+            export_netcdf(os.path.join(output, 'dgw.nc'), dgw, grace_time, gldas_lat,
+                          grace_lon, 'dgw')
+            export_chunks(os.path.join(output, 'dgw_chunks'), dgw, grace_time,
+                          gldas_lat, grace_lon, 'dgw')
+
+        with stage('partial_reads'):
+            for path in [os.path.join(output, 'dgw.nc'), os.path.join(output, 'dgw_chunks')]:
+                read_series(path, ref_cell[0], ref_cell[1])
+                read_map(path, len(grace_time)//2)
+
+        # Maps as in dgw_animation.py.
+        with stage('rendering'):
+            fig = plt.figure(figsize = (5, 7))
+            ax = plt.axes(projection = ccrs.PlateCarree())
+            ax.contourf(monthly_map[0], transform = ccrs.PlateCarree(), cmap = 'rainbow_r',
+                        extent = [grace_lon[0] - 360, grace_lon[-1] - 360,
+                                  gldas_lat[0], gldas_lat[-1]],
+                        levels = np.linspace(-15, 15, 7), extend = 'both')
+            shp_provinces = shpreader.Reader(os.path.join(shapefiles, 'provinces.shp'))
+            ax.add_feature(ShapelyFeature(shp_provinces.geometries(), ccrs.PlateCarree()),
+                           linewidth = 0.6, edgecolor = 'black', facecolor = 'none')
+            ax.set_xlim(111 - 180, 124.5 - 180)
+            ax.set_ylim(-40, -21)
+            fig.savefig(os.path.join(output, 'map.png'), bbox_inches = 'tight')
+            plt.close(fig)
+    finally:
+        shutil.rmtree(output)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the results of a benchmark with a baseline.
+
+    Arguments:
+    results, baseline -- Dictionaries {case: {stage: record}}.
+    tolerance -- Relative increase allowed.
+
+    Returns:
+    regressions -- List of strings describing the regressions.
+    """
+
+    regressions = []
+    for case, stages in results.items():
+        for name, record in stages.items():
+            base = baseline.get(case, {}).get(name)
+            if base is None:
+                continue
+            for key, minimum in [('wall_s', min_wall), ('traced_peak_mb', min_memory)]:
+                if record.get(key) is None or base.get(key) is None:
+                    continue
+                if (record[key] > base[key]*(1 + tolerance)
+                        and record[key] - base[key] > minimum):
+                    regressions.append('{} {} {}: {:.3f} -> {:.3f}'.format(
+                        case, name, key, base[key], record[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the pipeline on synthetic data.')
+    parser.add_argument('--cases', nargs = '+', default = default_cases,
+                        help = 'resolution:years, e.g. 0.5:15')
+    parser.add_argument('--data-dir', default = 'synthetic',
+                        help = 'folder where synthetic data sets are written and reused')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'runs per case, the fastest one is kept')
+    parser.add_argument('--no-memory', action = 'store_true',
+                        help = 'do not trace memory allocations (faster, less overhead)')
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--baseline', default = 'benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action = 'store_true',
+                        help = 'record these results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.2)
+    args = parser.parse_args()
+
+    profiling.enable([] if args.no_memory else ['memory'], report_at_exit = False)
+
+    results = {}
+    for case in args.cases:
+        resolution, years = float(case.split(':')[0]), int(case.split(':')[1])
+        folder = os.path.join(args.data_dir, '{:g}deg_{}y'.format(resolution, years))
+        if not os.path.exists(os.path.join(folder, 'data', factors_file)):
+            print('Writing synthetic data in', folder)
+            write_synthetic(folder, resolution, years)
+
+        runs = []
+        for i in range(args.repeat):
+            profiling.stages.clear()
+            run_case(folder)
+            runs.append({name: dict(record) for name, record in profiling.stages.items()})
+        results[case] = min(runs, key = lambda run: sum(record['wall_s'] for record in
+                                                        run.values() if not record['parent']))
+
+        print('\n{:<26}{:>11}{:>11}{:>11}'.format(case + ' degrees:years', 'Wall [s]',
+                                                 'CPU [s]', 'Peak [MB]'))
+        for record in results[case].values():
+            print('{:<26}{:>11.3f}{:>11.3f}{:>11}'.format(
+                '  '*record['depth'] + record['name'], record['wall_s'],
+                record['cpu_s'], '-' if record['traced_peak_mb'] is None
+                else '{:.1f}'.format(record['traced_peak_mb'])))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent = 2)
+        print('\nBaseline saved in', args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        print('\nRegressions against', args.baseline + ':', len(regressions))
+        for regression in regressions:
+            print('  ' + regression)
+        if regressions:
+            sys.exit(1)
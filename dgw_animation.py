@@ -6,6 +6,7 @@ from cartopy.feature import ShapelyFeature
 from matplotlib import ticker
 import matplotlib.animation as animation
 from functions import days2date
+from profiling import stage
 import numpy.ma as ma
 
 
@@ -14,6 +15,7 @@ import numpy.ma as ma
 #=======================================================
 
 # Load the output from dgw_calculation.py.
+# Load 'dgw_filled.npz' (dgw_gap_filling.py) instead to work with gap filled data.
 npzfile = np.load('dgw.npz')
 
 dgw_data = npzfile['dgw_filtered_data']
@@ -103,12 +105,13 @@ def animate(i):
     return plot, prov_plot, polygon_plot, title
 
 # Call the animation function.
-anim = animation.FuncAnimation(fig, animate, frames = np.arange(0, 155), interval = 250, blit = False)
+anim = animation.FuncAnimation(fig, animate, frames = np.arange(0, len(dates)), interval = 250, blit = False)
 
 # Save the animation as a .gif file.
-writergif = animation.PillowWriter(fps = 4) 
-anim.save('dgw_animation.gif', writer = writergif)
+with stage('render'):
+    writergif = animation.PillowWriter(fps = 4) 
+    anim.save('dgw_animation.gif', writer = writergif)
 
-# Save the animation in .mp4 format.
-writervideo = animation.FFMpegWriter(fps = 4) 
-anim.save('dgw_animation.mp4', writer = writervideo)
+    # Save the animation in .mp4 format.
+    writervideo = animation.FFMpegWriter(fps = 4) 
+    anim.save('dgw_animation.mp4', writer = writervideo)
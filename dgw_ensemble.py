@@ -0,0 +1,140 @@
+from netCDF4 import Dataset
+import numpy as np
+import numpy.ma as ma
+from functions import (days2date, temporal_interpolation, inside_polygon,
+                       load_components, assemble_storage, draw_realizations,
+                       ensemble_percentiles, matching_rows, reference_cell, 
+                       grace_storage)
+from dgw_calculation import gldas_models, gldas_components
+
+
+# Number of realizations of the ensemble.
+n_realizations = 1000
+
+# Relative standard deviation of the scale factors.
+scale_sigma = 0.1
+
+# GLDAS components of gldas_models (dgw_calculation.py) sorted by depth. Each 
+# realization adds them from the shallowest one down to a random depth.
+depths = ['canopy', 'sm_0_10', 'sm_10_40', 'sm_40_100', 'sm_100_200']
+
+# Minimum number of GLDAS components in a realization, those of 
+# gldas_components in dgw_calculation.py.
+min_layers = len(gldas_components)
+
+# Percentiles of groundwater storage variations to export.
+percentiles = [5, 25, 50, 75, 95]
+
+# Seed of the random number generator, so an ensemble can be reproduced.
+# None draws a different ensemble in each run.
+seed = 0
+
+# Approximate memory of the block of cells computed in each process [MB].
+memory_mb = 256
+
+
+# The process pool imports this script again on platforms without fork.
+if __name__ == '__main__':
+
+    #=======================================================
+    #		                GLDAS
+    #=======================================================
+
+    # Same models and cached layers as dgw_calculation.py. Every layer is read
+    # once, converted from kg/m**2 to cm and rearranged in order to be 
+    # consistent with GRACE data.
+    gldas_layers = load_components(gldas_models)
+
+    gldas = Dataset(next(iter(gldas_models.values()))['file'])
+    gldas_lat = gldas.variables['lat']
+
+
+    #=======================================================
+    #						 GRACE
+    #=======================================================
+
+    # Load the three centers. Unlike the plain average in dgw_calculation.py,
+    # each realization weights them differently.
+    csr = Dataset('./data/GRCTellus.CSR.200204_201607.LND.RL05.DSTvSCS1409.nc')
+    jpl = Dataset('./data/GRCTellus.JPL.200204_201607.LND.RL05_1.DSTvSCS1411.nc')
+    gfz = Dataset('./data/GRCTellus.GFZ.200204_201607.LND.RL05.DSTvSCS1409.nc')
+
+    csr_lon = csr.variables['lon']
+    csr_lat = csr.variables['lat']
+    csr_time = csr.variables['time']
+
+    # Rearrange GRACE data in order to be consistent with GLDAS data (rows
+    # 30:180 at 1 degree).
+    rows = matching_rows(csr_lat[:], gldas_lat[:])
+    centers = ma.stack([center.variables['lwe_thickness'][:, rows, :]
+                        for center in [csr, jpl, gfz]])
+
+    factors = Dataset('./data/CLM4.SCALE_FACTOR.DS.G300KM.RL05.DSTvSCS1409.nc')
+    factors_data = factors.variables['SCALE_FACTOR'][rows, :]
+
+    # Water storage from the plain average, as in dgw_calculation.py. Mask in 
+    # time takes information from coordinates lat[25], lon[302] (at 1 degree)
+    # where there is data.
+    grace_ws = grace_storage(list(centers), factors_data)
+    ref_cell = reference_cell(gldas_lat[:], csr_lon[:])
+    time_mask = ma.getmaskarray(grace_ws)[:, ref_cell[0], ref_cell[1]]
+
+
+    #=======================================================
+    #			     Interpolation in time
+    #=======================================================
+
+    grace_dates = days2date(csr_time[:], source = 'grace')
+
+    layers_interp = {}
+    for model, config in gldas_models.items():
+        gldas_dates = days2date(ma.getdata(Dataset(config['file']).variables['time'][:]),
+                                source = 'gldas')
+        for component in depths:
+            layers_interp[model, component] = temporal_interpolation(
+                grace_dates, gldas_dates, grace_ws, gldas_layers[model, component],
+                ref_cell = ref_cell)
+
+
+    #=======================================================
+    #			     Area of interest
+    #=======================================================
+
+    # Keep only the cells inside the polygon, so the ensemble is computed on a
+    # compact (time x cells) matrix.
+    polygon_mask = inside_polygon(csr_lon[:], gldas_lat[:],
+                                  ma.zeros((1, len(gldas_lat), len(csr_lon)))).mask[0]
+    cells = ~polygon_mask
+
+    centers_cells = ma.getdata(centers)[:, :, cells]
+    factors_cells = ma.getdata(factors_data)[cells]
+    # Each component is the mean of the models.
+    layers_cells = {key: ma.getdata(layer)[:, cells] for key, layer in layers_interp.items()}
+    layers_cells = np.stack([assemble_storage(layers_cells, [component], list(gldas_models))
+                             for component in depths])
+
+
+    #=======================================================
+    #			     Monte Carlo ensemble
+    #=======================================================
+
+    weights, scale, depth = draw_realizations(n_realizations, len(centers),
+                                              len(depths), min_layers, scale_sigma,
+                                              seed = seed)
+
+    dgw_percentiles = ensemble_percentiles(weights, scale, depth, centers_cells,
+                                           factors_cells, layers_cells, ~time_mask,
+                                           q = percentiles, memory_mb = memory_mb)
+
+    # Go back to the full grid. Cells outside the polygon and months without
+    # GRACE data are masked.
+    dgw_ensemble = np.zeros((len(percentiles),) + grace_ws.shape)
+    dgw_ensemble[:, :, cells] = dgw_percentiles
+    dgw_ensemble_mask = np.logical_or(time_mask[None, :, None, None],
+                                      polygon_mask[None, None, :, :])
+    dgw_ensemble_mask = np.broadcast_to(dgw_ensemble_mask, dgw_ensemble.shape)
+
+    # Export data.
+    np.savez('dgw_ensemble', dgw_ensemble_data = dgw_ensemble,
+             dgw_ensemble_mask = dgw_ensemble_mask, percentiles = percentiles,
+             time = csr_time, lon = csr_lon, lat = gldas_lat)
@@ -0,0 +1,66 @@
+import numpy as np
+import numpy.ma as ma
+from datetime import date
+from functions import days2date, to_calendar, fill_gaps, gap_flags
+
+
+# Method to fill the gaps: 'harmonic', 'spline', 'ssa' or 'auto'.
+method = 'auto'
+
+# With method = 'auto', gaps up to max_short_gap months are filled with splines
+# and longer gaps with singular spectrum analysis.
+max_short_gap = 2
+
+
+#=======================================================
+#               Groundwater variations
+#=======================================================
+
+# Load the output from dgw_calculation.py.
+npzfile = np.load('dgw.npz')
+
+dgw_data = npzfile['dgw_filtered_data']
+dgw_mask = npzfile['dgw_filtered_mask']
+dgw = ma.masked_array(dgw_data, mask = dgw_mask)
+
+time = npzfile['time']
+dates = days2date(time, source = 'grace')
+
+lat = npzfile['lat']
+lon = npzfile['lon']
+
+
+#=======================================================
+#                  Monthly calendar
+#=======================================================
+
+# GRACE has months without a solution and months with masked data. Place the
+# data on a regular monthly calendar so both kinds of gaps are filled. Two
+# dates in the same month are never merged: one of them is moved to an empty
+# neighbouring month and flagged.
+months, positions, shifted, dgw_months = to_calendar(dgw, dates)
+
+# Days since 2002-01-01, like the time in dgw.npz.
+time_months = np.asarray([(d - date(2002, 1, 1)).days for d in months], dtype = float)
+time_months[positions] = time
+
+
+#=======================================================
+#                    Gap filling
+#=======================================================
+
+dgw_filled, flag = fill_gaps(dgw_months, months, method = method,
+                             max_short_gap = max_short_gap)
+
+# Observed data moved to a neighbouring month.
+moved = flag[positions[shifted]]
+moved[moved == gap_flags['observed']] = gap_flags['shifted']
+flag[positions[shifted]] = moved
+
+for name, value in gap_flags.items():
+    print('Months - cells', name + ':', np.sum(flag[:, ~dgw_filled.mask[0]] == value))
+
+# Export data. Same arrays as dgw.npz, so the other scripts can load it instead.
+np.savez('dgw_filled', dgw_filtered_data = dgw_filled.data,
+         dgw_filtered_mask = dgw_filled.mask, dgw_filled_flag = flag,
+         time = time_months, lon = lon, lat = lat)
@@ -1,6 +1,7 @@
 import numpy as np
 import numpy.ma as ma
-from functions import days2date, distance
+from functions import days2date, idw_point
+from profiling import stage
 import matplotlib.pyplot as plt
 from sklearn.linear_model import LinearRegression
 
@@ -10,6 +11,7 @@ from sklearn.linear_model import LinearRegression
 #=======================================================
 
 # Load the output from gw_calculation.py.
+# Load 'dgw_filled.npz' (dgw_gap_filling.py) instead to work with gap filled data.
 npzfile = np.load('dgw.npz')
 
 dgw_data = npzfile['dgw_filtered_data']
@@ -39,51 +41,8 @@ lon_point = np.asarray(input('Enter a longitude in grades ranging from 0 to 360:
 # lat_point = -34.9
 # lon_point = 302.06
 
-# Find the cell where the point is located.
-for i in lat:
-	if (i <= lat_point <= (i+1)):
-		lat_extremes = [i, i+1]
-		
-for i in lon:
-	if (i <= lon_point <= (i+1)):
-		lon_extremes = [i, i+1]
-
-lat_inds = np.where((lat >= lat_extremes[0]) & (lat <= lat_extremes[1]))
-lon_inds = np.where((lon >= lon_extremes[0]) & (lon <= lon_extremes[1]))
-
-lat_ind_min = np.amin(lat_inds)
-lat_ind_max = np.amax(lat_inds)	 
-lon_ind_min = np.amin(lon_inds)  
-lon_ind_max = np.amax(lon_inds)     
-
-# Check if there is data at the chosen point.
-data_nw = dgw[:, lat_ind_max, lon_ind_min] # North-West node
-data_sw = dgw[:, lat_ind_min, lon_ind_min] # South-West node
-data_ne = dgw[:, lat_ind_max, lon_ind_max] # North-East node
-data_se = dgw[:, lat_ind_min, lon_ind_max] # South-East node
-
-data = [data_nw, data_sw, data_ne, data_se]
-
-for d in data:
-    if d.mask.all() == True:
-        raise Exception('There is no data at the chosen point.')
-
-# Inverse distance weighting.
-dist_nw = distance(lat_point, lon_point, lat[lat_ind_max], lon[lon_ind_min])
-dist_sw = distance(lat_point, lon_point, lat[lat_ind_min], lon[lon_ind_min])
-dist_ne = distance(lat_point, lon_point, lat[lat_ind_max], lon[lon_ind_max])
-dist_se = distance(lat_point, lon_point, lat[lat_ind_min], lon[lon_ind_max])
-
-numerator, denominator = (0, 0)
-for data, dist in zip([data_nw, data_sw, data_ne, data_se], [dist_nw, dist_sw, dist_ne, dist_se]):
-    if np.all(data.mask == True):  
-        continue
-    else:
-        numerator = numerator + data/dist
-        denominator = denominator + 1/dist
-
 # Groundwater storage variations.
-dgw_point = numerator/denominator 
+dgw_point = idw_point(dgw, lat, lon, lat_point, lon_point)
 
 # Understanding the central tendency.
 dgw_point_mean = np.mean(dgw_point) # Mean
@@ -111,10 +70,11 @@ x = np.asarray(x).reshape(-1, n_features)
 y = dgw_point
 # LinearRegression needs y (array) of shape (n_samples,). 
 
-model = LinearRegression()
-model.fit(x, y)
+with stage('regression'):
+    model = LinearRegression()
+    model.fit(x, y)
 
-y_line = model.predict(x) 
+    y_line = model.predict(x) 
 
 # y_line = ax + b.
 a = model.coef_ # [cm/day]
@@ -141,7 +101,8 @@ plt.ylabel('Probability')
 plt.title('Histogram of groundwater variations. \n Lat = {:.2f}°, Lon = {:.2f}°.'.format(lat_point, lon_point))
 plt.legend()
 
-plt.savefig('histogram_point.png', bbox_inches = 'tight')
+with stage('render'):
+    plt.savefig('histogram_point.png', bbox_inches = 'tight')
 
 # Plot 2: Dates vs. Groundwater variations.
 plt.figure(2, figsize = (10, 5))
@@ -154,4 +115,5 @@ plt.ylabel('Groundwater variations in equivalent water thickness [cm]')
 plt.title('Groundwater variations \n Lat = {:.2f}°, Lon = {:.2f}°'.format(lat_point, lon_point))
 plt.legend()
 
-plt.savefig('dgw_point.png', bbox_inches = 'tight')
+with stage('render'):
+    plt.savefig('dgw_point.png', bbox_inches = 'tight')
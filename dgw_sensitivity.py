@@ -0,0 +1,116 @@
+from netCDF4 import Dataset
+import numpy as np
+import numpy.ma as ma
+from functions import (days2date, temporal_interpolation, inside_polygon,
+                       load_components, assemble_storage, grace_storage,
+                       matching_rows, reference_cell)
+from dgw_calculation import gldas_models
+
+
+# Components of gldas_models (dgw_calculation.py) sorted by depth. The sweep 
+# adds them down to each depth.
+depths = ['canopy', 'sm_0_10', 'sm_10_40', 'sm_40_100', 'sm_100_200']
+
+
+# The process pool of load_components imports this script again on platforms
+# without fork.
+if __name__ == '__main__':
+
+    #=======================================================
+    #		                GLDAS
+    #=======================================================
+
+    # Every layer is read once and cached (see dgw_calculation.py).
+    gldas_layers = load_components(gldas_models)
+
+    gldas = Dataset(next(iter(gldas_models.values()))['file'])
+    gldas_lat = gldas.variables['lat'][:]
+
+
+    #=======================================================
+    #						 GRACE
+    #=======================================================
+
+    csr = Dataset('./data/GRCTellus.CSR.200204_201607.LND.RL05.DSTvSCS1409.nc')
+    jpl = Dataset('./data/GRCTellus.JPL.200204_201607.LND.RL05_1.DSTvSCS1411.nc')
+    gfz = Dataset('./data/GRCTellus.GFZ.200204_201607.LND.RL05.DSTvSCS1409.nc')
+    factors = Dataset('./data/CLM4.SCALE_FACTOR.DS.G300KM.RL05.DSTvSCS1409.nc')
+
+    csr_lon = csr.variables['lon'][:]
+    csr_lat = csr.variables['lat'][:]
+    csr_time = csr.variables['time'][:]
+
+    factors_data = factors.variables['SCALE_FACTOR'][:, :]
+
+    # Average of the centers multiplied by the scale factors, as in 
+    # dgw_calculation.py, rearranged in order to be consistent with GLDAS data.
+    grace_ws = grace_storage([csr.variables['lwe_thickness'], jpl.variables['lwe_thickness'],
+                              gfz.variables['lwe_thickness']], factors_data)
+    grace_ws = ma.array(grace_ws[:, matching_rows(csr_lat, gldas_lat), :])
+    ref_cell = reference_cell(gldas_lat, csr_lon)
+    time_mask = ma.getmaskarray(grace_ws)[:, ref_cell[0], ref_cell[1]]
+
+
+    #=======================================================
+    #			     Interpolation in time
+    #=======================================================
+
+    # Interpolation is linear in the data, so each layer is interpolated once
+    # and every combination is a sum of interpolated layers.
+    grace_dates = days2date(csr_time, source = 'grace')
+
+    layers_interp = {}
+    for model, config in gldas_models.items():
+        gldas_dates = days2date(ma.getdata(Dataset(config['file']).variables['time'][:]),
+                                source = 'gldas')
+        for component in depths:
+            layers_interp[model, component] = temporal_interpolation(
+                grace_dates, gldas_dates, grace_ws, gldas_layers[model, component],
+                ref_cell = ref_cell)
+
+
+    #=======================================================
+    #			     Area of interest
+    #=======================================================
+
+    cells = ~inside_polygon(csr_lon, gldas_lat,
+                            ma.zeros((1, len(gldas_lat), len(csr_lon)))).mask[0]
+
+    # Compact (time x cells) matrices.
+    grace_cells = ma.getdata(grace_ws)[:, cells]
+    layers_cells = {key: ma.getdata(layer)[:, cells] for key, layer in layers_interp.items()}
+
+
+    #=======================================================
+    #			     Sensitivity sweep
+    #=======================================================
+
+    # Each model alone and the multi-model mean, for every depth.
+    model_sets = [[model] for model in gldas_models]
+    if len(gldas_models) > 1:
+        model_sets.append(list(gldas_models))
+
+    valid = ~time_mask
+    t = np.asarray([d.toordinal() for d in grace_dates])/365.25
+
+    names, series, trends = [], [], []
+    for models in model_sets:
+        for depth in range(2, len(depths) + 1):
+            gldas_ws = assemble_storage(layers_cells, depths[:depth], models)
+
+            # Regional mean of groundwater storage variations.
+            dws = grace_cells - gldas_ws
+            dgw = np.mean(dws - np.mean(dws[valid], axis = 0), axis = 1)
+            dgw = ma.masked_array(dgw, mask = time_mask)
+
+            names.append('+'.join(models) + ': ' + ' + '.join(depths[:depth]))
+            series.append(dgw)
+            trends.append(np.polyfit(t[valid], dgw[valid], 1)[0])
+
+    for name, trend in zip(names, trends):
+        print('{:<70} {:6.2f} cm/year'.format(name, trend))
+
+    # Export data.
+    series = ma.stack(series)
+    np.savez('dgw_sensitivity', names = names, dgw_mean_data = series.data,
+             dgw_mean_mask = series.mask, trends = trends, time = csr_time)
@@ -0,0 +1,145 @@
+import json
+import numpy as np
+import numpy.ma as ma
+from datetime import date
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from functions import days2date, idw_point, load_npz
+
+
+# Address of the service.
+host = '127.0.0.1'
+port = 8000
+
+# Output from dgw_calculation.py (or dgw_gap_filling.py).
+path = 'dgw.npz'
+
+# Decimals of the coordinates used as key of the cache of point series, and
+# number of point series kept in it.
+precision = 2
+cache_size = 4096
+
+
+#=======================================================
+#               Groundwater variations
+#=======================================================
+
+# Memory map the output from dgw_calculation.py once. Queries only read the
+# cells they need.
+npzfile = load_npz(path)
+
+dgw = ma.masked_array(npzfile['dgw_filtered_data'], mask = npzfile['dgw_filtered_mask'])
+
+time = np.asarray(npzfile['time'])
+dates = days2date(time, source = 'grace')
+dates_iso = [d.isoformat() for d in dates]
+
+lat = np.asarray(npzfile['lat'])
+lon = np.asarray(npzfile['lon'])
+
+
+#=======================================================
+#                       Queries
+#=======================================================
+
+def to_list(data):
+    # Masked values are returned as null.
+    return [None if m else float(v) for v, m in
+            zip(ma.getdata(data), ma.getmaskarray(data))]
+
+
+@lru_cache(maxsize = cache_size)
+def point_series(lat_point, lon_point):
+    return to_list(idw_point(dgw, lat, lon, lat_point, lon_point))
+
+
+def point_query(query):
+    # Groundwater storage variations at a point, as in dgw_point.py.
+    lat_point = round(float(query['lat']), precision)
+    lon_point = round(float(query['lon']), precision)
+    # The series is interpolated at the rounded coordinates, which are returned.
+    return {'lat': lat_point, 'lon': lon_point, 'dates': dates_iso,
+            'dgw': point_series(lat_point, lon_point)}
+
+
+def region_query(query):
+    # Mean groundwater storage variations of the cells inside a lat/lon box.
+    lat_inds = np.flatnonzero((lat >= query['lat'][0]) & (lat <= query['lat'][1]))
+    lon_inds = np.flatnonzero((lon >= query['lon'][0]) & (lon <= query['lon'][1]))
+    if len(lat_inds) == 0 or len(lon_inds) == 0:
+        raise Exception('There are no cells in the chosen region.')
+    region = dgw[:, lat_inds[0]:lat_inds[-1] + 1, lon_inds[0]:lon_inds[-1] + 1]
+    return {'dates': dates_iso, 'dgw': to_list(ma.mean(region, axis = (1, 2)))}
+
+
+def map_query(query):
+    # Maps between two dates. Only cells with data are returned.
+    start = date.fromisoformat(query['start'])
+    end = date.fromisoformat(query['end'])
+    inds = [i for i, d in enumerate(dates) if start <= d <= end]
+    maps = dgw[inds]
+    lat_inds, lon_inds = np.nonzero(~ma.getmaskarray(maps).all(axis = 0))
+    return {'dates': [dates_iso[i] for i in inds],
+            'lat': lat[lat_inds].tolist(), 'lon': lon[lon_inds].tolist(),
+            'dgw': [to_list(m[lat_inds, lon_inds]) for m in maps]}
+
+
+queries = {'point': point_query, 'region': region_query, 'map': map_query}
+
+
+def answer(query):
+    try:
+        if query.get('type') not in queries:
+            raise Exception('Unknown query type.')
+        return queries[query['type']](query)
+    except Exception as error:
+        return {'error': str(error)}
+
+
+#=======================================================
+#                       Service
+#=======================================================
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    POST /query with a JSON list of queries, for example
+    [{"type": "point", "lat": -34.9, "lon": 302.06},
+     {"type": "region", "lat": [-36, -33], "lon": [300, 303]},
+     {"type": "map", "start": "2005-01-01", "end": "2005-12-31"}],
+    returns a JSON list with one answer per query.
+    GET /point?lat=-34.9&lon=302.06 answers a single point query.
+    """
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/query':
+            return self.send_json(404, {'error': 'Not found.'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            batch = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.send_json(400, {'error': 'Invalid JSON.'})
+        if not isinstance(batch, list):
+            batch = [batch]
+        self.send_json(200, [answer(query) for query in batch])
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/point':
+            return self.send_json(404, {'error': 'Not found.'})
+        params = {key: value[0] for key, value in parse_qs(url.query).items()}
+        self.send_json(200, answer(dict(params, type = 'point')))
+
+
+if __name__ == '__main__':
+    server = ThreadingHTTPServer((host, port), Handler)
+    print('Serving groundwater storage variations on http://{}:{}'.format(host, port))
+    server.serve_forever()
@@ -1,8 +1,18 @@
+import os
+import json
+import zlib
+import itertools
 import numpy as np
 from datetime import date, timedelta
+from dateutil.relativedelta import relativedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from netCDF4 import Dataset
 from scipy.interpolate import CubicSpline
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
 import cartopy.io.shapereader as shpreader
 from shapely.geometry import Point
+from profiling import profiled, stage
 
 
 def days2date(days, source):
@@ -31,7 +41,73 @@ def days2date(days, source):
     return dates
 
 
-def temporal_interpolation(grace_dates, gldas_dates, grace_data, gldas_data):
+def matching_rows(lat, target_lat):
+    """
+    Find the rows of a grid that match the latitudes of another grid, e.g. 
+    the rows of GRACE (-90 to 90 degrees) that cover GLDAS (-60 to 90 
+    degrees), which are 30:180 at 1 degree.
+    
+    Arguments:
+    lat -- Array of latitudes of the grid.
+    target_lat -- Array of latitudes to match, with the same resolution.
+    
+    Returns:
+    rows -- Slice of the rows of lat.
+    """
+    
+    first = int(np.argmin(np.abs(np.asarray(lat) - target_lat[0])))
+    
+    return slice(first, first + len(target_lat))
+
+
+def reference_cell(lat, lon, lat_point = -34.5, lon_point = 302.5):
+    """
+    Find the cell used to find the months without GRACE data, a cell with 
+    data inside the area of interest. It is lat[25], lon[302] at 1 degree.
+    
+    Arguments:
+    lat, lon -- Arrays of latitudes and longitudes (0 to 360) in degrees.
+    lat_point, lon_point -- Coordinates of the cell in degrees.
+    
+    Returns:
+    ref_cell -- Indexes (lat, lon) of the closest cell.
+    """
+    
+    return (int(np.argmin(np.abs(np.asarray(lat) - lat_point))), 
+            int(np.argmin(np.abs(np.asarray(lon) - lon_point))))
+
+
+@profiled
+def grace_storage(centers, factors):
+    """
+    Calculate water storage variations from GRACE as the average of the 
+    centers (CSR, JPL and GFZ) multiplied by the scale factors.
+    
+    Arguments:
+    centers -- List of netCDF variables or masked arrays (time, lat, lon) with
+    equivalent water thickness [cm].
+    factors -- Masked array (lat, lon) with the scale factors.
+    
+    Returns:
+    grace_ws -- Masked array (time, lat, lon) with water storage variations [cm].
+    """
+    
+    average_data = centers[0][:, :, :]
+    for center in centers[1:]:
+        average_data = average_data + center[:, :, :]
+    average_data = average_data / len(centers)
+    
+    grace_ws = np.ma.masked_all(average_data.shape)
+    
+    for i in range (0, len(average_data)):
+        grace_ws[i] = np.multiply(average_data[i, :, :], factors[:, :])
+        
+    return grace_ws
+
+
+@profiled
+def temporal_interpolation(grace_dates, gldas_dates, grace_data, gldas_data, 
+                           ref_cell = (25, 302)):
     """
     Interpolate GLDAS data in time to match GRACE data.
     
@@ -40,6 +116,8 @@ def temporal_interpolation(grace_dates, gldas_dates, grace_data, gldas_data):
     gldas_dates -- GLDAS list of date objects.
     grace_data -- GRACE masked array to create final mask.
     gldas_data -- GLDAS masked array to be interpolated.
+    ref_cell -- Indexes (lat, lon) of a cell with data, used to find the
+    months without GRACE data.
     
     Returns:
     gldas_data_interp -- GLDAS masked array interpolated.
@@ -62,19 +140,46 @@ def temporal_interpolation(grace_dates, gldas_dates, grace_data, gldas_data):
         gldas_days.append((gldas_dates_array[i] - start_date).days)
 		
     # Cubic spline data interpolator.
-    f_interp = CubicSpline(gldas_days, gldas_data[:,:,:], axis = 0)
+    with stage('cubic_spline'):
+        f_interp = CubicSpline(gldas_days, gldas_data[:,:,:], axis = 0)
+        gldas_interp = f_interp(x)
     # Use GRACE mask in time and GLDAS mask in space.
-    # Mask in time takes information from coordinates lat[25], lon[302] where
-    # there is data.
-    time_mask = grace_data.mask[:, 25, 302]
+    # Mask in time takes information from coordinates lat[25], lon[302] (by 
+    # default) where there is data.
+    time_mask = grace_data.mask[:, ref_cell[0], ref_cell[1]]
     mixed_mask = np.logical_or(time_mask[:, None, None], 
                                gldas_data.mask[0, :, :][None, :, :])
-    gldas_data_interp = np.ma.array(f_interp(x), mask = mixed_mask)
+    gldas_data_interp = np.ma.array(gldas_interp, mask = mixed_mask)
     
     return gldas_data_interp
 
 
-def inside_polygon(lon, lat, data):
+@profiled
+def interpolate_models(grace_dates, gldas_dates, grace_data, gldas_data, 
+                       ref_cell = (25, 302)):
+    """
+    Interpolate the water storage of each land surface model in time to match
+    GRACE data and average the models.
+    
+    Arguments:
+    grace_dates -- GRACE list of date objects.
+    gldas_dates -- Dictionary {model: GLDAS list of date objects}.
+    grace_data -- GRACE masked array to create final mask.
+    gldas_data -- Dictionary {model: GLDAS masked array to be interpolated}.
+    ref_cell -- Same as in temporal_interpolation.
+    
+    Returns:
+    gldas_data_interp -- GLDAS masked array interpolated, multi-model mean.
+    """
+    
+    return np.ma.mean(np.ma.stack([temporal_interpolation(grace_dates, gldas_dates[model],
+                                                          grace_data, gldas_data[model],
+                                                          ref_cell = ref_cell)
+                                   for model in gldas_data]), axis = 0)
+
+
+@profiled
+def inside_polygon(lon, lat, data, shapefile = './shapefiles/loess_holes.shp'):
     """
     Filter data inside the polygon.
     
@@ -82,6 +187,7 @@ def inside_polygon(lon, lat, data):
     lon -- Masked array of longitudes.
     lat -- Masked array of latitudes.
     data -- Masked array to be filtered.
+    shapefile -- Path to the shapefile with the polygon.
     
     Returns:
     filtered_data -- Filtered masked array.
@@ -91,7 +197,7 @@ def inside_polygon(lon, lat, data):
 
     # Read shapefile. The shapefile has information about the limits of the area
     # of interest.
-    shp = shpreader.Reader('./shapefiles/loess_holes.shp')
+    shp = shpreader.Reader(shapefile)
     polygon = next(shp.geometries())
 
     # Redefine lon_grid because longitude in polygon takes values between -180 and 180.
@@ -126,6 +232,54 @@ def inside_polygon(lon, lat, data):
     
     return filtered_data
 
+
+@profiled
+def groundwater_anomalies(grace_ws, gldas_ws):
+    """
+    Calculate groundwater storage variations as the difference between the 
+    anomalies of GRACE and GLDAS water storage, both relative to their mean 
+    for the study period.
+    
+    Arguments:
+    grace_ws -- Masked array (time, lat, lon) with GRACE water storage [cm].
+    gldas_ws -- Masked array (time, lat, lon) with GLDAS water storage 
+    interpolated to GRACE dates [cm].
+    
+    Returns:
+    dgw -- Masked array (time, lat, lon) with groundwater storage variations [cm].
+    """
+    
+    gldas_dws = gldas_ws - np.ma.mean(gldas_ws, axis = 0)
+    grace_dws = grace_ws - np.ma.mean(grace_ws, axis = 0)
+    
+    return grace_dws - gldas_dws
+
+
+@profiled
+def filter_area(lon, lat, dgw, grace_ws, ref_cell = (25, 302), 
+                shapefile = './shapefiles/loess_holes.shp'):
+    """
+    Keep groundwater storage variations inside the area of interest and in 
+    the months with GRACE data.
+    
+    Arguments:
+    lon, lat -- Arrays of longitudes and latitudes.
+    dgw -- Masked array (time, lat, lon) to be filtered.
+    grace_ws -- GRACE masked array, used to find the months without data.
+    ref_cell -- Same as in temporal_interpolation.
+    shapefile -- Same as in inside_polygon.
+    
+    Returns:
+    dgw_filtered -- Filtered masked array.
+    """
+    
+    dgw = inside_polygon(lon, lat, dgw, shapefile = shapefile)
+    
+    time_mask = np.ma.getmaskarray(grace_ws)[:, ref_cell[0], ref_cell[1]]
+    mixed_mask = np.logical_or(time_mask[:, None, None], np.ma.getmaskarray(dgw))
+    
+    return np.ma.masked_array(np.ma.getdata(dgw), mask = mixed_mask)
+
 	
 def distance(lat0, lon0, lat1, lon1):
     """
@@ -148,3 +302,983 @@ def distance(lat0, lon0, lat1, lon1):
     dist = np.sqrt((dif_lat*scalar)**2 + (dif_lon*scalar)**2)
     
     return dist
+
+
+@profiled
+def idw_point(data, lat, lon, lat_point, lon_point):
+    """
+    Interpolate data at a point with inverse distance weighting of the four
+    nodes of the cell where the point is located.
+    
+    Arguments:
+    data -- Masked array (time, lat, lon) to be interpolated.
+    lat, lon -- Arrays of latitudes and longitudes in ascending order.
+    lat_point, lon_point -- Coordinates of the point in degrees. Longitude 
+    ranging from 0 to 360.
+    
+    Returns:
+    data_point -- Masked array (time,) interpolated at the point.
+    """
+    
+    if not (lat[0] <= lat_point <= lat[-1] and lon[0] <= lon_point <= lon[-1]):
+        raise Exception('The chosen point is outside the grid.')
+    
+    # Find the cell where the point is located.
+    lat_ind_min = min(np.searchsorted(lat, lat_point, side = 'right') - 1, len(lat) - 2)
+    lon_ind_min = min(np.searchsorted(lon, lon_point, side = 'right') - 1, len(lon) - 2)
+    lat_ind_max = lat_ind_min + 1
+    lon_ind_max = lon_ind_min + 1
+    
+    # North-West, South-West, North-East and South-East nodes.
+    nodes = [(lat_ind_max, lon_ind_min), (lat_ind_min, lon_ind_min), 
+             (lat_ind_max, lon_ind_max), (lat_ind_min, lon_ind_max)]
+    
+    numerator, denominator = (0, 0)
+    for i, j in nodes:
+        data_node = data[:, i, j]
+        # Check if there is data at the chosen point.
+        if np.ma.getmaskarray(data_node).all():
+            raise Exception('There is no data at the chosen point.')
+        dist = distance(lat_point, lon_point, lat[i], lon[j])
+        numerator = numerator + data_node/dist
+        denominator = denominator + 1/dist
+        
+    data_point = numerator/denominator
+    
+    return data_point
+
+
+def load_npz(path):
+    """
+    Load the arrays of a .npz file as memory maps. The arrays are extracted 
+    once to .npy files in a folder next to the .npz file, since arrays inside
+    a .npz file can not be memory mapped.
+    
+    Arguments:
+    path -- Path to the .npz file.
+    
+    Returns:
+    arrays -- Dictionary with the memory mapped arrays.
+    """
+    
+    folder = os.path.splitext(path)[0] + '_npy'
+    os.makedirs(folder, exist_ok = True)
+    
+    npzfile = np.load(path)
+    arrays = {}
+    for name in npzfile.files:
+        npy = os.path.join(folder, name + '.npy')
+        if not os.path.exists(npy) or os.path.getmtime(npy) < os.path.getmtime(path):
+            np.save(npy, npzfile[name])
+        arrays[name] = np.load(npy, mmap_mode = 'r')
+        
+    return arrays
+
+
+@profiled
+def monthly_means(data, dates):
+    """
+    Calculate monthly mean maps and the variations relative to them.
+    
+    Arguments:
+    data -- Masked array (time, lat, lon).
+    dates -- List of date objects, one per map.
+    
+    Returns:
+    monthly_map -- Masked array (12, lat, lon) with the mean of all the 
+    January maps, February maps, etc.
+    dev -- Masked array (time, lat, lon) with the variations relative to the
+    monthly mean map of each date.
+    """
+    
+    months = np.asarray([d.month for d in dates])
+    
+    monthly_map = np.ma.masked_array(np.zeros((12,) + data.shape[1:]), mask = True)
+    dev = np.ma.masked_array(np.zeros(data.shape), mask = True)
+    
+    for i in range(12):
+        ind = np.flatnonzero(months == i + 1)
+        if len(ind) == 0:
+            continue
+        monthly_map[i] = np.ma.mean(data[ind], axis = 0)
+        dev[ind] = data[ind] - monthly_map[i]
+        
+    return monthly_map, dev
+
+
+@profiled
+def annual_means(dev, dates, years, shift = 6):
+    """
+    Calculate annual mean maps, for years that start in a month other than
+    January.
+    
+    Arguments:
+    dev -- Masked array (time, lat, lon), usually from monthly_means.
+    dates -- List of date objects, one per map.
+    years -- List of years.
+    shift -- Months the dates are shifted before taking the year. With 6, a
+    year goes from July of the previous year to June.
+    
+    Returns:
+    annual_map -- Masked array (len(years), lat, lon) with the annual means.
+    """
+    
+    shifted = np.asarray([(d + relativedelta(months = shift)).year for d in dates])
+    
+    annual_map = np.ma.masked_array(np.zeros((len(years),) + dev.shape[1:]), mask = True)
+    for i, year in enumerate(years):
+        annual_map[i] = np.ma.mean(dev[shifted == year], axis = 0)
+        
+    return annual_map
+
+
+def _source(path, variable):
+    # Identity of a cached layer: the netCDF file (path, size and modification
+    # time) and the variable.
+    stat = os.stat(path)
+    return {'file': os.path.abspath(path), 'size': stat.st_size, 
+            'mtime_ns': stat.st_mtime_ns, 'variable': variable}
+
+
+def _load_layer(path, variable, cache):
+    # Read a GLDAS variable, convert it from kg/m**2 to cm (water_density = 
+    # 1000 kg/m**3) and rearrange it in longitude to be consistent with GRACE.
+    with Dataset(path) as nc:
+        layer = nc.variables[variable][:, :, :]*0.1
+    half = layer.shape[2]//2
+    layer = np.ma.concatenate((layer[:, :, half:], layer[:, :, :half]), axis = 2)
+    np.save(cache + '_data.npy', np.ma.getdata(layer))
+    np.save(cache + '_mask.npy', np.ma.getmaskarray(layer))
+    # The source is written last, so an interrupted write is not reused.
+    with open(cache + '_source.json', 'w') as f:
+        json.dump(_source(path, variable), f)
+    return cache
+
+
+def _cached(path, variable, cache):
+    # True when the cache was written from the same file and variable.
+    try:
+        with open(cache + '_source.json') as f:
+            return json.load(f) == _source(path, variable)
+    except (OSError, ValueError):
+        return False
+
+
+@profiled
+def load_components(models, cache_dir = './cache', workers = None):
+    """
+    Load the storage components of one or more land surface models (Noah, 
+    CLM, VIC, Catchment, etc.). Each layer is read once, in parallel, and the 
+    converted cube is cached in .npy files, reused while the path, size and 
+    modification time of the netCDF file do not change.
+    
+    Arguments:
+    models -- Dictionary {model: {'file': path, 'layers': {component: 
+    variable}}} with the netCDF file of each model and the name of the
+    variable of each component (e.g. {'canopy': 'CanopInt_inst'}).
+    cache_dir -- Folder of the cache.
+    workers -- Number of processes. None uses all the CPUs.
+    
+    Returns:
+    layers -- Dictionary {(model, component): masked array (time, lat, lon)}
+    with water storage in cm, memory mapped from the cache.
+    """
+    
+    os.makedirs(cache_dir, exist_ok = True)
+    
+    caches, missing = {}, []
+    for model, config in models.items():
+        for component, variable in config['layers'].items():
+            # Each file has its own cache, so switching files does not reuse
+            # the layers of another one.
+            file_id = zlib.crc32(os.path.abspath(config['file']).encode())
+            cache = os.path.join(cache_dir, '{}_{}_{:08x}'.format(model, variable, file_id))
+            caches[model, component] = cache
+            if not _cached(config['file'], variable, cache):
+                missing.append((config['file'], variable, cache))
+    
+    # netCDF files can not be read from several threads, so layers are read
+    # in a process pool.
+    if len(missing) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            list(pool.map(_load_layer, *zip(*missing)))
+    else:
+        for args in missing:
+            _load_layer(*args)
+    
+    layers = {}
+    for key, cache in caches.items():
+        layers[key] = np.ma.masked_array(np.load(cache + '_data.npy', mmap_mode = 'r'),
+                                         mask = np.load(cache + '_mask.npy', mmap_mode = 'r'))
+        
+    return layers
+
+
+def assemble_storage(layers, components, models):
+    """
+    Add storage components and average them over land surface models.
+    
+    Arguments:
+    layers -- Dictionary {(model, component): masked array} from 
+    load_components (or interpolated in time).
+    components -- List of components to add, e.g. ['canopy', 'sm_0_10'].
+    models -- List of models to average.
+    
+    Returns:
+    ws -- Masked array (time, lat, lon) with water storage [cm].
+    """
+    
+    ws = [sum(layers[model, component] for component in components) 
+          for model in models]
+    
+    if len(ws) == 1:
+        return ws[0]
+    return np.ma.mean(np.ma.stack(ws), axis = 0)
+
+
+def draw_realizations(n, n_centers, n_layers, min_layers, scale_sigma, 
+                      concentration = 10, seed = None):
+    """
+    Draw the random inputs of a Monte Carlo ensemble of groundwater storage 
+    variations.
+    
+    Arguments:
+    n -- Number of realizations.
+    n_centers -- Number of GRACE centers (CSR, JPL, GFZ).
+    n_layers -- Number of GLDAS components, sorted from the shallowest to the
+    deepest one.
+    min_layers -- Minimum number of GLDAS components added in a realization.
+    scale_sigma -- Relative standard deviation of the scale factors.
+    concentration -- Dirichlet concentration of the center weights. The larger,
+    the closer the weights are to the plain average.
+    seed -- Seed of the random number generator.
+    
+    Returns:
+    weights -- Array (n, n_centers) with the weight of each GRACE center. 
+    Each row adds up to 1.
+    scale -- Array (n,) with the multiplicative perturbation of the scale factors.
+    layers -- Boolean array (n, n_layers) with True for the GLDAS components 
+    included in each realization.
+    """
+    
+    rng = np.random.default_rng(seed)
+    
+    weights = rng.dirichlet(concentration*np.ones(n_centers), size = n)
+    scale = 1 + scale_sigma*rng.standard_normal(n)
+    
+    # Each realization adds the components down to a random depth.
+    depth = rng.integers(min_layers, n_layers + 1, size = n)
+    layers = np.arange(n_layers)[None, :] < depth[:, None]
+    
+    return weights, scale, layers
+
+
+def ensemble_dgw(weights, scale, layers, centers, factors, gldas, valid):
+    """
+    Calculate groundwater storage variations for a batch of realizations at
+    once. The data is compact: only the cells of interest are kept.
+    
+    Arguments:
+    weights, scale, layers -- Realizations from draw_realizations.
+    centers -- Array (n_centers, time, cells) with GRACE equivalent water 
+    thickness [cm].
+    factors -- Array (cells,) with the scale factors.
+    gldas -- Array (n_layers, time, cells) with GLDAS components interpolated 
+    to GRACE dates [cm].
+    valid -- Boolean array (time,) with True for the months with GRACE data.
+    
+    Returns:
+    dgw -- Array (realizations, time, cells) with groundwater storage 
+    variations [cm].
+    """
+    
+    grace_ws = np.einsum('nc,ctk->ntk', weights, centers)
+    grace_ws *= scale[:, None, None]*factors[None, None, :]
+    
+    gldas_ws = np.einsum('nl,ltk->ntk', layers.astype(gldas.dtype), gldas)
+    
+    # Both anomalies are referred to the mean of the same months, so the 
+    # difference of anomalies is the anomaly of the difference.
+    dgw = grace_ws - gldas_ws
+    dgw -= np.mean(dgw[:, valid, :], axis = 1, keepdims = True)
+    
+    return dgw
+
+
+# Inputs shared by every block of cells in a worker process.
+_ensemble_inputs = {}
+
+
+def _init_ensemble_worker(weights, scale, layers, centers, factors, gldas, valid, q):
+    _ensemble_inputs.update(weights = weights, scale = scale, layers = layers, 
+                            centers = centers, factors = factors, gldas = gldas, 
+                            valid = valid, q = q)
+
+
+def _ensemble_block(cells, weights, scale, layers, centers, factors, gldas, valid, q):
+    dgw = ensemble_dgw(weights, scale, layers, centers[:, :, cells], factors[cells], 
+                       gldas[:, :, cells], valid)
+    return np.percentile(dgw, q, axis = 0)
+
+
+def _ensemble_block_worker(cells):
+    return _ensemble_block(cells, **_ensemble_inputs)
+
+
+@profiled
+def ensemble_percentiles(weights, scale, layers, centers, factors, gldas, valid,
+                         q = (5, 50, 95), memory_mb = 256, workers = None):
+    """
+    Propagate a Monte Carlo ensemble through the conceptual model and 
+    summarize it with percentiles. The cells are split in blocks that are 
+    computed in a process pool. Each block holds every realization, so only 
+    one block of the ensemble is in memory per process and the percentiles 
+    are the only result sent back.
+    
+    Arguments:
+    weights, scale, layers -- Realizations from draw_realizations.
+    centers, factors, gldas, valid -- Compact inputs of ensemble_dgw.
+    q -- Percentiles to compute, between 0 and 100.
+    memory_mb -- Approximate memory of the ensemble of a block [MB]. It sets
+    the number of cells of the blocks.
+    workers -- Number of processes. None uses all the CPUs, 1 avoids the pool.
+    
+    Returns:
+    dgw_percentiles -- Array (len(q), time, cells) with the percentiles of 
+    groundwater storage variations [cm].
+    """
+    
+    n, n_time, n_cells = len(scale), centers.shape[1], centers.shape[2]
+    
+    # ensemble_dgw keeps about three float64 arrays (n, time, block).
+    block_size = max(1, int(memory_mb*2**20/(3*8*n*n_time)))
+    blocks = [slice(s, min(s + block_size, n_cells)) 
+              for s in range(0, n_cells, block_size)]
+    
+    dgw_percentiles = np.empty((len(q), n_time, n_cells))
+    inputs = (weights, scale, layers, centers, factors, gldas, valid, q)
+    
+    if workers == 1 or len(blocks) == 1:
+        for cells in blocks:
+            dgw_percentiles[:, :, cells] = _ensemble_block(cells, *inputs)
+    else:
+        with ProcessPoolExecutor(max_workers = workers, 
+                                 initializer = _init_ensemble_worker, 
+                                 initargs = inputs) as pool:
+            for cells, result in zip(blocks, pool.map(_ensemble_block_worker, blocks)):
+                dgw_percentiles[:, :, cells] = result
+    
+    return dgw_percentiles
+
+
+def complete_months(dates):
+    """
+    Build a regular monthly calendar that covers a list of dates, so that
+    the missing months can be filled.
+    
+    GRACE solutions sometimes span two calendar months, so two dates can fall
+    in the same month (e.g. 2012-01-02 and 2012-01-30). The date closest to
+    the middle of the month keeps it and the other one is moved to the empty
+    month before or after it, the one on its side of the month first.
+    
+    Arguments:
+    dates -- List of date objects (datetime.date), one per month.
+    
+    Returns:
+    months -- List of date objects, one per month of the calendar. Months 
+    already in dates keep their date, the others take day 15.
+    positions -- Array with the position of each of the dates in months.
+    shifted -- Boolean array with True for the dates moved to a neighbouring
+    month.
+    """
+    
+    first = dates[0].year*12 + dates[0].month - 1
+    positions = np.asarray([d.year*12 + d.month - 1 - first for d in dates])
+    shifted = np.zeros(len(dates), dtype = bool)
+    
+    taken = set(positions.tolist())
+    for p in np.unique(positions[np.bincount(positions)[positions] > 1]):
+        inds = np.flatnonzero(positions == p)
+        keep = inds[np.argmin([abs(dates[i].day - 15) for i in inds])]
+        for i in inds[inds != keep]:
+            sides = [p - 1, p + 1] if dates[i].day < 15 else [p + 1, p - 1]
+            free = [q for q in sides if q >= 0 and q not in taken]
+            if not free:
+                raise Exception('There is no empty month next to {} for {}.'.format(
+                    dates[keep], dates[i]))
+            positions[i] = free[0]
+            shifted[i] = True
+            taken.add(free[0])
+    
+    months = []
+    for i in range(0, positions.max() + 1):
+        months.append(date((first + i)//12, (first + i)%12 + 1, 15))
+    for i, d in zip(positions, dates):
+        months[i] = d
+        
+    return months, positions, shifted
+
+
+def to_calendar(data, dates):
+    """
+    Place maps on the regular monthly calendar of complete_months. The 
+    missing months are masked.
+    
+    Arguments:
+    data -- Masked array (time, lat, lon).
+    dates -- List of date objects, one per map.
+    
+    Returns:
+    months, positions, shifted -- Same as in complete_months.
+    data_months -- Masked array (len(months), lat, lon).
+    """
+    
+    months, positions, shifted = complete_months(dates)
+    
+    data_months = np.ma.masked_all((len(months),) + data.shape[1:])
+    data_months[positions] = data
+    
+    return months, positions, shifted, data_months
+
+
+# Flags of gap filled data. Observed data moved to a neighbouring month by
+# complete_months is flagged as 'shifted'.
+gap_flags = {'observed': 0, 'harmonic': 1, 'spline': 2, 'ssa': 3, 'shifted': 4}
+
+
+def gap_lengths(missing):
+    """
+    Measure the length of the gaps in a set of series.
+    
+    Arguments:
+    missing -- Boolean array (time, cells) with True where data is missing.
+    
+    Returns:
+    lengths -- Array (time, cells) with the length of the gap each missing 
+    value belongs to, and 0 where data is not missing.
+    """
+    
+    lengths = np.zeros(missing.shape, dtype = int)
+    
+    # Forward pass counts the months since the gap started, backward pass 
+    # spreads the total length to the whole gap.
+    for i in range(0, len(missing)):
+        lengths[i] = (lengths[i - 1] + 1)*missing[i] if i > 0 else missing[i]
+    for i in range(len(missing) - 2, -1, -1):
+        lengths[i] = np.where(missing[i] & missing[i + 1], lengths[i + 1], lengths[i])
+        
+    return lengths
+
+
+def harmonic_fit(t, y, missing, n_harmonics = 2):
+    """
+    Fit a trend plus annual harmonics to a set of series and evaluate it. 
+    Series with the same missing months are fitted in one least squares solve.
+    
+    Arguments:
+    t -- Array (time,) with time in years.
+    y -- Array (time, cells) with the series.
+    missing -- Boolean array (time, cells) with True where data is missing.
+    n_harmonics -- Number of harmonics of the annual cycle.
+    
+    Returns:
+    y_fit -- Array (time, cells) with the fitted series.
+    """
+    
+    columns = [np.ones(len(t)), t - np.mean(t)]
+    for k in range(1, n_harmonics + 1):
+        columns += [np.cos(2*np.pi*k*t), np.sin(2*np.pi*k*t)]
+    x = np.stack(columns, axis = 1)
+    
+    y_fit = np.empty(y.shape)
+    patterns, group = np.unique(missing.T, axis = 0, return_inverse = True)
+    for i, pattern in enumerate(patterns):
+        cols = group.ravel() == i
+        coef = np.linalg.lstsq(x[~pattern], y[~pattern][:, cols], rcond = None)[0]
+        y_fit[:, cols] = x @ coef
+        
+    return y_fit
+
+
+def spline_fit(t, y, missing):
+    """
+    Interpolate a set of series with cubic splines through the available 
+    data. Series with the same missing months share one spline.
+    
+    Arguments:
+    t -- Array (time,) with time in years.
+    y -- Array (time, cells) with the series.
+    missing -- Boolean array (time, cells) with True where data is missing.
+    
+    Returns:
+    y_fit -- Array (time, cells) with the interpolated series. Months before
+    the first or after the last available data are not extrapolated (NaN).
+    """
+    
+    y_fit = np.full(y.shape, np.nan)
+    patterns, group = np.unique(missing.T, axis = 0, return_inverse = True)
+    for i, pattern in enumerate(patterns):
+        cols = group.ravel() == i
+        f_interp = CubicSpline(t[~pattern], y[~pattern][:, cols], axis = 0, 
+                               extrapolate = False)
+        y_fit[:, cols] = f_interp(t)
+        
+    return y_fit
+
+
+def ssa_fit(y, missing, y_first, window = 24, rank = 4, n_iter = 100, tol = 1e-3):
+    """
+    Fill the gaps of a set of series with iterative singular spectrum analysis
+    (Kondrashov & Ghil, 2006). All the series are decomposed at once.
+    
+    Arguments:
+    y -- Array (time, cells) with the series.
+    missing -- Boolean array (time, cells) with True where data is missing.
+    y_first -- Array (time, cells) with the first guess of the missing data.
+    window -- Embedding window in months.
+    rank -- Number of components kept in the reconstruction.
+    n_iter -- Maximum number of iterations.
+    tol -- Largest change [cm] of the filled values to stop iterating.
+    
+    Returns:
+    y_fit -- Array (time, cells) with the series filled.
+    """
+    
+    y_fit = np.where(missing, y_first, y)
+    n_lag = len(y) - window + 1
+    
+    for i in range(0, n_iter):
+        # Trajectory matrices (cells, n_lag, window), decomposed in one batch.
+        traj = sliding_window_view(y_fit.T, window, axis = 1)
+        u, sv, vt = np.linalg.svd(traj, full_matrices = False)
+        recon = (u[:, :, :rank]*sv[:, None, :rank]) @ vt[:, :rank, :]
+        
+        # Diagonal averaging back to series.
+        total = np.zeros(y_fit.T.shape)
+        count = np.zeros(len(y))
+        for j in range(0, window):
+            total[:, j:j + n_lag] += recon[:, :, j]
+            count[j:j + n_lag] += 1
+        y_new = np.where(missing, (total/count).T, y)
+        
+        change = np.max(np.abs(y_new - y_fit)) if missing.any() else 0
+        y_fit = y_new
+        if change < tol:
+            break
+        
+    return y_fit
+
+
+@profiled
+def fill_gaps(data, dates, method = 'auto', max_short_gap = 2, n_harmonics = 2, 
+              window = 24, rank = 4):
+    """
+    Fill missing months for all the cells with data at once.
+    
+    Arguments:
+    data -- Masked array (time, lat, lon), with masked missing months.
+    dates -- List of date objects, one per month.
+    method -- 'harmonic' (trend plus annual harmonics), 'spline' (cubic 
+    splines), 'ssa' (iterative singular spectrum analysis) or 'auto' (splines 
+    for gaps up to max_short_gap months and SSA for longer gaps).
+    max_short_gap -- Longest gap filled with splines when method is 'auto'.
+    n_harmonics -- Number of harmonics of the annual cycle.
+    window, rank -- Parameters of ssa_fit.
+    
+    Returns:
+    filled_data -- Masked array (time, lat, lon), only masked in cells without
+    data.
+    flag -- Array (time, lat, lon) with the gap_flags value of each month.
+    """
+    
+    mask = np.ma.getmaskarray(data)
+    cells = ~mask.all(axis = 0)
+    
+    # Compact (time x cells) matrix.
+    y = np.ma.getdata(data)[:, cells]
+    missing = mask[:, cells]
+    t = np.asarray([d.toordinal() for d in dates])/365.25
+    
+    fill = harmonic_fit(t, y, missing, n_harmonics)
+    kind = np.full(y.shape, gap_flags['harmonic'], dtype = np.int8)
+    
+    if method in ['spline', 'auto']:
+        spline = spline_fit(t, y, missing)
+        use = ~np.isnan(spline)
+        if method == 'auto':
+            use &= gap_lengths(missing) <= max_short_gap
+        fill[use] = spline[use]
+        kind[use] = gap_flags['spline']
+        
+    if method in ['ssa', 'auto']:
+        ssa = ssa_fit(y, missing, fill, window, rank)
+        if method == 'ssa':
+            use = np.ones(y.shape, dtype = bool)
+        else:
+            use = kind == gap_flags['harmonic']
+        fill[use] = ssa[use]
+        kind[use] = gap_flags['ssa']
+        
+    kind[~missing] = gap_flags['observed']
+    
+    filled_data = np.zeros(data.shape)
+    filled_data[:, cells] = np.where(missing, fill, y)
+    filled_data = np.ma.masked_array(filled_data, 
+                                     mask = np.broadcast_to(~cells, data.shape).copy())
+    
+    flag = np.zeros(data.shape, dtype = np.int8)
+    flag[:, cells] = kind
+    
+    return filled_data, flag
+
+
+# Columns of the tables returned by detect_events.
+event_dtype = [('kind', 'U8'), ('lat_ind', int), ('lon_ind', int), ('onset', int), 
+               ('duration', int), ('severity', float), ('peak', float)]
+region_dtype = [('kind', 'U8'), ('month', int), ('label', int), ('cells', int), 
+                ('mean', float), ('peak', float)]
+extreme_dtype = [('kind', 'U3'), ('rank', int), ('lat_ind', int), ('lon_ind', int), 
+                 ('month', int), ('value', float)]
+label_dtype = [('month', int), ('lat_ind', int), ('lon_ind', int), ('label', int)]
+
+
+@profiled
+def detect_events(dev, threshold, k = 3, min_duration = 1):
+    """
+    Detect drought and recharge events in one pass over a cube of deviations.
+    A drought (recharge) is a run of months with deviation below -threshold 
+    (above threshold). Masked months are skipped and do not break a run.
+    
+    Arguments:
+    dev -- Masked array (time, lat, lon) with deviations [cm].
+    threshold -- Deviation [cm] beyond which a month belongs to an event.
+    k -- Number of extremes kept per cell.
+    min_duration -- Shortest event reported, in months.
+    
+    Returns:
+    events -- Table (event_dtype) with one row per event and cell: onset 
+    (month index), duration (months), severity (sum of deviations, cm) and 
+    peak (largest deviation, cm).
+    regions -- Table (region_dtype) with one row per connected region of
+    cells in drought or recharge each month.
+    extremes -- Table (extreme_dtype) with the k largest ('max') and smallest
+    ('min') deviations of each cell.
+    labels -- Table (label_dtype) with one row per cell inside a region and 
+    month, with the label of its region in regions. Cells outside regions 
+    have no row.
+    """
+    
+    mask = np.ma.getmaskarray(dev)
+    cells = ~mask.all(axis = 0)
+    lat_ind, lon_ind = np.nonzero(cells)
+    n = len(lat_ind)
+    columns = np.arange(n)
+    
+    top = {'max': np.full((k, n), -np.inf), 'min': np.full((k, n), np.inf)}
+    top_month = {'max': np.full((k, n), -1), 'min': np.full((k, n), -1)}
+    
+    kinds = {'drought': -1, 'recharge': 1}
+    onset = {kind: np.zeros(n, dtype = int) for kind in kinds}
+    duration = {kind: np.zeros(n, dtype = int) for kind in kinds}
+    severity = {kind: np.zeros(n) for kind in kinds}
+    peak = {kind: np.zeros(n) for kind in kinds}
+    
+    events, regions, labels = [], [], []
+    
+    def close_runs(kind, ended):
+        ended = ended & (duration[kind] >= min_duration)
+        rows = np.empty(np.count_nonzero(ended), dtype = event_dtype)
+        rows['kind'] = kind
+        rows['lat_ind'], rows['lon_ind'] = lat_ind[ended], lon_ind[ended]
+        rows['onset'], rows['duration'] = onset[kind][ended], duration[kind][ended]
+        rows['severity'] = severity[kind][ended]
+        rows['peak'] = kinds[kind]*peak[kind][ended]
+        events.append(rows)
+    
+    for i in range(0, len(dev)):
+        x = np.ma.getdata(dev[i])[cells]
+        valid = ~mask[i][cells]
+        
+        # Replace the smallest of the k maxima (largest of the k minima).
+        for name, sign in [('max', 1), ('min', -1)]:
+            low = np.argmin(sign*top[name], axis = 0)
+            update = valid & (sign*x > sign*top[name][low, columns])
+            top[name][low[update], columns[update]] = x[update]
+            top_month[name][low[update], columns[update]] = i
+        
+        label = 0
+        for kind, sign in kinds.items():
+            inside = valid & (sign*x > threshold)
+            close_runs(kind, valid & ~inside & (duration[kind] > 0))
+            duration[kind][valid & ~inside] = 0
+            
+            start = inside & (duration[kind] == 0)
+            onset[kind][start] = i
+            severity[kind][start] = 0
+            peak[kind][start] = 0
+            duration[kind][inside] += 1
+            severity[kind][inside] += x[inside]
+            peak[kind][inside] = np.maximum(peak[kind][inside], sign*x[inside])
+            
+            # Connected regions in the month.
+            grid = np.zeros(cells.shape, dtype = bool)
+            grid[cells] = inside
+            lab, n_lab = ndimage.label(grid)
+            lab[grid] += label
+            cell_lat, cell_lon = np.nonzero(grid)
+            rows = np.empty(len(cell_lat), dtype = label_dtype)
+            rows['month'], rows['lat_ind'], rows['lon_ind'] = i, cell_lat, cell_lon
+            rows['label'] = lab[grid]
+            labels.append(rows)
+            
+            values = np.zeros(cells.shape)
+            values[cells] = x
+            ids = np.arange(label + 1, label + n_lab + 1)
+            rows = np.empty(n_lab, dtype = region_dtype)
+            rows['kind'], rows['month'], rows['label'] = kind, i, ids
+            rows['cells'] = ndimage.sum_labels(grid, lab, ids)
+            rows['mean'] = ndimage.mean(values, lab, ids)
+            if n_lab > 0:
+                extreme = ndimage.minimum if sign < 0 else ndimage.maximum
+                rows['peak'] = extreme(values, lab, ids)
+            regions.append(rows)
+            label += n_lab
+    
+    # Runs still open at the end of the record.
+    for kind in kinds:
+        close_runs(kind, duration[kind] > 0)
+    
+    extremes = []
+    for name, sign in [('max', 1), ('min', -1)]:
+        order = np.argsort(-sign*top[name], axis = 0)
+        value = np.take_along_axis(top[name], order, axis = 0)
+        month = np.take_along_axis(top_month[name], order, axis = 0)
+        rows = np.empty(value.shape, dtype = extreme_dtype)
+        rows['kind'] = name
+        rows['rank'] = np.arange(1, k + 1)[:, None]
+        rows['lat_ind'], rows['lon_ind'] = lat_ind[None, :], lon_ind[None, :]
+        rows['month'], rows['value'] = month, value
+        extremes.append(rows[month >= 0])
+    
+    events = np.concatenate(events)
+    regions = np.concatenate(regions)
+    extremes = np.concatenate(extremes)
+    labels = np.concatenate(labels)
+    
+    return events, regions, extremes, labels
+
+
+def chunk_shape(chunks, shape):
+    """
+    Arguments:
+    chunks -- Size of the chunks in each dimension, None for the whole dimension.
+    shape -- Shape of the data.
+    
+    Returns:
+    chunks -- List with the size of the chunks, at most the shape of the data.
+    """
+    
+    return [n if c is None else min(c, n) for c, n in zip(chunks, shape)]
+
+
+@profiled
+def export_netcdf(path, data, time, lat, lon, name, units = 'cm', long_name = '', 
+                  chunks = (12, 10, 10), dtype = 'f4', fill_value = -9999.0, 
+                  level = 4):
+    """
+    Export a cube to a chunked and compressed netCDF4 file with CF metadata.
+    Reading a cell (time series) or a month (map) only decompresses the 
+    chunks that contain it.
+    
+    Arguments:
+    path -- Path to the netCDF file.
+    data -- Masked array (time, lat, lon) to be exported.
+    time -- Array with days since 2002-01-01.
+    lat, lon -- Arrays of latitudes and longitudes in degrees.
+    name -- Name of the variable.
+    units, long_name -- Attributes of the variable.
+    chunks -- Size of the chunks in (time, lat, lon). None takes the whole 
+    dimension. With the default, a year of 10x10 cells, the time series of a 
+    cell decompresses one chunk per year and the map of a month one year of 
+    maps. Longer chunks in time favour time series and shorter ones maps.
+    dtype -- Data type stored.
+    fill_value -- Value stored where data is masked.
+    level -- Compression level, from 1 to 9.
+    """
+    
+    with Dataset(path, 'w') as nc:
+        nc.Conventions = 'CF-1.8'
+        
+        for dim, values in zip(['time', 'lat', 'lon'], [time, lat, lon]):
+            nc.createDimension(dim, len(values))
+            nc.createVariable(dim, 'f8', (dim,))[:] = values
+        
+        nc.variables['time'].setncatts({'standard_name': 'time', 'calendar': 'standard',
+                                        'units': 'days since 2002-01-01 00:00:00'})
+        nc.variables['lat'].setncatts({'standard_name': 'latitude', 
+                                       'units': 'degrees_north'})
+        nc.variables['lon'].setncatts({'standard_name': 'longitude', 
+                                       'units': 'degrees_east'})
+        
+        var = nc.createVariable(name, dtype, ('time', 'lat', 'lon'), zlib = True, 
+                                complevel = level, shuffle = True, 
+                                chunksizes = chunk_shape(chunks, data.shape),
+                                fill_value = fill_value)
+        var.setncatts({'units': units, 'long_name': long_name})
+        var[:] = np.ma.asarray(data)
+
+
+@profiled
+def export_chunks(path, data, time, lat, lon, name, units = 'cm', long_name = '', 
+                  chunks = (12, 10, 10), dtype = 'f4', fill_value = -9999.0, 
+                  level = 4, workers = None):
+    """
+    Export a cube to a folder of zlib compressed chunks, written in parallel.
+    Chunks without data are not written. The folder has a metadata.json file
+    with the layout, the attributes and the coordinates.
+    
+    Arguments:
+    path -- Path to the folder.
+    data, time, lat, lon, name, units, long_name, chunks, dtype, fill_value, 
+    level -- Same as in export_netcdf.
+    workers -- Number of threads. None lets the executor choose.
+    """
+    
+    os.makedirs(path, exist_ok = True)
+    
+    # Remove the chunks of a previous export.
+    for file in os.listdir(path):
+        if file.replace('.', '').isdigit():
+            os.remove(os.path.join(path, file))
+    
+    values = np.ma.filled(np.ma.asarray(data).astype(dtype), fill_value)
+    chunks = chunk_shape(chunks, values.shape)
+    
+    def write_chunk(index):
+        block = tuple(slice(i*c, (i + 1)*c) for i, c in zip(index, chunks))
+        chunk = values[block]
+        if np.all(chunk == fill_value):
+            return
+        with open(os.path.join(path, '.'.join(map(str, index))), 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(chunk).tobytes(), level))
+    
+    indexes = itertools.product(*[range(0, -(-n//c)) for n, c in zip(values.shape, chunks)])
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        list(pool.map(write_chunk, indexes))
+    
+    metadata = {'name': name, 'dims': ['time', 'lat', 'lon'], 
+                'shape': list(values.shape), 'chunks': list(chunks), 
+                'dtype': np.dtype(dtype).str, 'fill_value': fill_value, 
+                'compressor': 'zlib', 'level': level,
+                'attrs': {'units': units, 'long_name': long_name},
+                'coords': {'time': np.asarray(time).tolist(), 
+                           'lat': np.asarray(lat).tolist(), 
+                           'lon': np.asarray(lon).tolist()},
+                'coords_attrs': {'time': {'units': 'days since 2002-01-01 00:00:00'},
+                                 'lat': {'units': 'degrees_north'},
+                                 'lon': {'units': 'degrees_east'}}}
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+
+def read_chunk(path, metadata, index):
+    """
+    Read a chunk exported with export_chunks.
+    
+    Arguments:
+    path -- Path to the folder.
+    metadata -- Dictionary from metadata.json.
+    index -- Tuple with the position of the chunk in (time, lat, lon).
+    
+    Returns:
+    chunk -- Array with the chunk. Chunks without data are filled.
+    """
+    
+    shape = [min(c, n - i*c) for i, c, n in zip(index, metadata['chunks'], metadata['shape'])]
+    file = os.path.join(path, '.'.join(map(str, index)))
+    
+    if not os.path.exists(file):
+        return np.full(shape, metadata['fill_value'], dtype = metadata['dtype'])
+    with open(file, 'rb') as f:
+        chunk = np.frombuffer(zlib.decompress(f.read()), dtype = metadata['dtype'])
+        
+    return chunk.reshape(shape)
+
+
+def read_series(path, lat_ind, lon_ind, name = None):
+    """
+    Read the time series of a cell from a netCDF file (export_netcdf) or a 
+    folder of chunks (export_chunks). Only the chunks that contain the cell
+    are decompressed.
+    
+    Arguments:
+    path -- Path to the netCDF file or the folder.
+    lat_ind, lon_ind -- Indexes of the cell.
+    name -- Name of the variable in the netCDF file. By default, the first 
+    variable with dimensions (time, lat, lon).
+    
+    Returns:
+    series -- Masked array (time,).
+    """
+    
+    if not os.path.isdir(path):
+        with Dataset(path) as nc:
+            return nc.variables[name or cube_name(nc)][:, lat_ind, lon_ind]
+    
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    ct, cy, cx = metadata['chunks']
+    
+    series = np.concatenate([read_chunk(path, metadata, (i, lat_ind//cy, lon_ind//cx))
+                             [:, lat_ind%cy, lon_ind%cx] 
+                             for i in range(0, -(-metadata['shape'][0]//ct))])
+    
+    return np.ma.masked_equal(series, metadata['fill_value'])
+
+
+def read_map(path, time_ind, name = None):
+    """
+    Read the map of a month from a netCDF file (export_netcdf) or a folder of
+    chunks (export_chunks). Only the chunks that contain the month are
+    decompressed.
+    
+    Arguments:
+    path -- Path to the netCDF file or the folder.
+    time_ind -- Index of the month.
+    name -- Same as in read_series.
+    
+    Returns:
+    data_map -- Masked array (lat, lon).
+    """
+    
+    if not os.path.isdir(path):
+        with Dataset(path) as nc:
+            return nc.variables[name or cube_name(nc)][time_ind, :, :]
+    
+    with open(os.path.join(path, 'metadata.json')) as f:
+        metadata = json.load(f)
+    ct, cy, cx = metadata['chunks']
+    n_lat, n_lon = metadata['shape'][1:]
+    
+    data_map = np.block([[read_chunk(path, metadata, (time_ind//ct, i, j))[time_ind%ct]
+                          for j in range(0, -(-n_lon//cx))]
+                         for i in range(0, -(-n_lat//cy))])
+    
+    return np.ma.masked_equal(data_map, metadata['fill_value'])
+
+
+def cube_name(nc):
+    """
+    Find the first variable with dimensions (time, lat, lon) in a netCDF file.
+    
+    Arguments:
+    nc -- netCDF4 Dataset.
+    
+    Returns:
+    name -- Name of the variable.
+    """
+    
+    for name, var in nc.variables.items():
+        if var.dimensions == ('time', 'lat', 'lon'):
+            return name
+    raise Exception('There is no (time, lat, lon) variable in the file.')
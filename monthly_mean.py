@@ -1,17 +1,25 @@
 import numpy as np
 import numpy.ma as ma
-from functions import days2date
+from functions import (days2date, monthly_means, detect_events, export_netcdf,
+                       export_chunks)
+from profiling import stage
 import matplotlib.pyplot as plt
 from cartopy.feature import ShapelyFeature
 import cartopy.io.shapereader as shpreader
 import cartopy.crs as ccrs
 
 
+# Besides dev.npz and dev.nc, also export a folder of compressed chunks 
+# (dev_chunks), written in parallel.
+export_chunk_folder = False
+
+
 #=======================================================
 #               Groundwater variations
 #=======================================================
 
 # Load the output from dgw_calculation.py.
+# Load 'dgw_filled.npz' (dgw_gap_filling.py) instead to work with gap filled data.
 npzfile = np.load('dgw.npz')
 
 dgw_data = npzfile['dgw_filtered_data']
@@ -31,54 +39,62 @@ lon = npzfile['lon']
 
 # Calculate monthly mean variations.
 
-# List of months.
-n = np.asarray([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])
-
-# Group the maps by month.
-ind_month = [[] for i in range(len(n))]
-for i in range(len(n)):
-    for j in range(len(dates)):
-        if dates[j].month == n[i]:
-            ind_month[i].append(j)
-
 # Take all the January maps for the period 2002-2016 and average them. 
 # The same with the other months.
-monthly_map = np.zeros(shape = (len(n), 150, 360))
-monthly_map = np.ma.masked_array(monthly_map, mask = True)
-
-for i in range(len(n)):
-    monthly_map[i, :, :] = (np.ma.mean(dgw[ind_month[i], :, :], axis = 0))
-
-# Variations relative to the monthly mean maps.
-# Useful for creating annual mean maps (annual_mean.py).
-dev = np.zeros(shape = (len(dates), 150, 360))
-dev = np.ma.masked_array(dev, mask = True)
-for i in range(len(n)):
-    for j in range(len(dates)):
-        if dates[j].month == n[i]:
-            dev[j] = dgw[j, :, :] - monthly_map[i]
+# Variations relative to the monthly mean maps are useful for creating annual 
+# mean maps (annual_mean.py).
+monthly_map, dev = monthly_means(dgw, dates)
 
 # Export data. Useful in annual_mean.py.
 np.savez('dev', dev_data = dev.data, dev_mask = dev.mask)
 
+# Export data to a chunked and compressed store.
+export_netcdf('dev.nc', dev, time, lat, lon, 'dev',
+              long_name = 'Groundwater storage variations relative to the monthly mean')
+if export_chunk_folder:
+    export_chunks('dev_chunks', dev, time, lat, lon, 'dev',
+                  long_name = 'Groundwater storage variations relative to the monthly mean')
+
 
 #===================================================
 #                  Extreme cases
 #===================================================
 
-# Month with maximum positive deviation.    
-dev_max = np.amax(dev[:, :, :])
-dev_max_ind = np.argwhere(dev == dev_max)
-print('Maximum positive deviation in cm of EWT:', dev_max)
+# Deviation in cm of EWT beyond which a month is part of a drought (below 
+# -threshold) or a recharge event (above threshold).
+threshold = 10
+
+# Detect events and keep the 3 largest and smallest deviations of each cell 
+# in one pass over the deviations.
+events, regions, extremes, labels = detect_events(dev, threshold, k = 3)
+
+# Month with maximum positive deviation.
+dev_max = extremes[extremes['kind'] == 'max']
+dev_max = dev_max[np.argmax(dev_max['value'])]
+print('Maximum positive deviation in cm of EWT:', dev_max['value'])
 print('Month - year when maximum positive deviation happened:',
-      dates[dev_max_ind[0][0]].month, '-', dates[dev_max_ind[0][0]].year)
+      dates[dev_max['month']].month, '-', dates[dev_max['month']].year)
 
 # Month with maximum negative deviation.
-dev_min = np.amin(dev[:, :, :])
-dev_min_ind = np.argwhere(dev == dev_min)
-print('Maximum negative deviation in cm of EWT:', dev_min)
+dev_min = extremes[extremes['kind'] == 'min']
+dev_min = dev_min[np.argmin(dev_min['value'])]
+print('Maximum negative deviation in cm of EWT:', dev_min['value'])
 print('Month - year when maximum negative deviation happened:',
-      dates[dev_min_ind[0][0]].month, '-', dates[dev_min_ind[0][0]].year)
+      dates[dev_min['month']].month, '-', dates[dev_min['month']].year)
+
+# Longest drought and recharge events.
+for kind in ['drought', 'recharge']:
+    kind_events = events[events['kind'] == kind]
+    print('Number of', kind, 'events (all cells):', len(kind_events))
+    if len(kind_events) > 0:
+        longest = kind_events[np.argmax(kind_events['duration'])]
+        print('Longest', kind, 'in months:', longest['duration'], 'since',
+              dates[longest['onset']].month, '-', dates[longest['onset']].year)
+
+# Export event tables. Cell indexes refer to lat and lon from dgw.npz and 
+# months to time.
+np.savez('events', events = events, regions = regions, extremes = extremes,
+         labels = labels)
 
     
 #==================================================
@@ -144,4 +160,5 @@ cb.ax.tick_params(labelsize = 14)
 
 # Save plot as a .png image.
 # plt.savefig('monthly_mean_jan2jun.png', bbox_inches = 'tight')
-plt.savefig('monthly_mean_jul2dec.png', bbox_inches = 'tight')
\ No newline at end of file
+with stage('render'):
+    plt.savefig('monthly_mean_jul2dec.png', bbox_inches = 'tight')
\ No newline at end of file
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import functools
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows.
+    resource = None
+
+
+# Instrumentation is off by default. It is turned on with the environment
+# variable DGW_PROFILE, a comma separated list of options:
+#   DGW_PROFILE=1                  Time of each stage, and resident set size (RSS) high-water
+#                                  mark of the process: at the exit of the stage and its
+#                                  increase during the stage.
+#   DGW_PROFILE=memory             Also peak of memory allocated by Python (tracemalloc).
+#   DGW_PROFILE=memory,cprofile    Also a cProfile file for each top-level stage.
+# Reports are written to the folder in DGW_PROFILE_DIR (current folder by default).
+
+options = set()
+stages = {}
+_stack = []
+_null = nullcontext()
+_start = None
+
+
+def enable(profile_options = ('time',), report_at_exit = True):
+    """
+    Turn the instrumentation on and write the report when the script ends.
+
+    Arguments:
+    profile_options -- Options among 'time', 'memory' and 'cprofile'.
+    report_at_exit -- False to collect the stages without writing the report.
+    """
+
+    global _start
+
+    if not options:
+        if report_at_exit:
+            atexit.register(report)
+        _start = time.perf_counter()
+    options.update(set(profile_options) & {'time', 'memory', 'cprofile'})
+    options.add('time')
+    if 'memory' in options and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def rss_peak():
+    """
+    Returns:
+    rss -- High-water mark of the resident set size of the process [MB].
+    """
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes in Linux, bytes in macOS.
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10
+
+
+@contextmanager
+def _measure(name):
+    entry = {'traced_peak': 0}
+    profiler = None
+
+    if 'memory' in options:
+        if _stack:
+            _stack[-1]['traced_peak'] = max(_stack[-1]['traced_peak'],
+                                            tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    if 'cprofile' in options and not _stack:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    parent = _stack[-1]['name'] if _stack else None
+    record = stages.setdefault(name, {'name': name, 'parent': parent, 'depth': len(_stack),
+                                      'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                      'rss_peak_mb': None, 'rss_growth_mb': None,
+                                      'traced_peak_mb': None})
+    entry['name'] = name
+    _stack.append(entry)
+    rss = rss_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _stack.pop()
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_output('{}.prof'.format(name)))
+        if 'memory' in options:
+            entry['traced_peak'] = max(entry['traced_peak'],
+                                       tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            if _stack:
+                _stack[-1]['traced_peak'] = max(_stack[-1]['traced_peak'],
+                                                entry['traced_peak'])
+
+        record['calls'] += 1
+        record['wall_s'] += wall
+        record['cpu_s'] += cpu
+        # The high-water mark is of the whole process, so it never decreases.
+        # Its increase during the stage is added over the calls.
+        record['rss_peak_mb'] = rss_peak()
+        if rss is not None:
+            record['rss_growth_mb'] = (record['rss_growth_mb'] or 0) + record['rss_peak_mb'] - rss
+        if 'memory' in options:
+            record['traced_peak_mb'] = max(record['traced_peak_mb'] or 0,
+                                           entry['traced_peak']/2**20)
+
+
+def stage(name):
+    """
+    Context manager that measures a named stage of a script. It does nothing
+    when the instrumentation is off.
+
+    Arguments:
+    name -- Name of the stage.
+    """
+
+    if not options:
+        return _null
+    return _measure(name)
+
+
+def profiled(func = None, name = None):
+    """
+    Decorator that measures every call of a function as a stage, named after
+    the function unless a name is given.
+    """
+
+    if func is None:
+        return functools.partial(profiled, name = name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not options:
+            return func(*args, **kwargs)
+        with _measure(name or func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _script():
+    return os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+
+
+def _output(suffix):
+    folder = os.environ.get('DGW_PROFILE_DIR', '.')
+    os.makedirs(folder, exist_ok = True)
+    return os.path.join(folder, 'profile_{}_{}'.format(_script(), suffix))
+
+
+def report(path = None):
+    """
+    Write the run report as JSON and print a summary table of the stages.
+    Called automatically at exit when the instrumentation is on.
+
+    Arguments:
+    path -- Path to the JSON file. By default profile_<script>_report.json.
+
+    Returns:
+    run -- Dictionary with the run report.
+    """
+
+    if not options:
+        return None
+
+    run = {'script': _script(), 'argv': sys.argv, 'python': sys.version.split()[0],
+           'date': datetime.now().isoformat(timespec = 'seconds'),
+           'options': sorted(options),
+           'wall_s': time.perf_counter() - _start if _start else None,
+           'rss_peak_mb': rss_peak(), 'stages': list(stages.values())}
+
+    with open(path or _output('report.json'), 'w') as f:
+        json.dump(run, f, indent = 2)
+
+    # RSS is the high-water mark of the process at the exit of the stage and
+    # RSS+ its increase during the stage.
+    print('\n{:<32}{:>7}{:>11}{:>11}{:>11}{:>11}{:>11}'.format(
+        'Stage', 'Calls', 'Wall [s]', 'CPU [s]', 'RSS [MB]', 'RSS+ [MB]', 'Peak [MB]'),
+        file = sys.stderr)
+    for record in run['stages']:
+        indent = '  '*record['depth']
+        print('{:<32}{:>7}{:>11.3f}{:>11.3f}{:>11}{:>11}{:>11}'.format(
+            (indent + record['name'])[:31], record['calls'], record['wall_s'],
+            record['cpu_s'], _mb(record['rss_peak_mb']), _mb(record['rss_growth_mb']),
+            _mb(record['traced_peak_mb'])), file = sys.stderr)
+
+    return run
+
+
+def _mb(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+if os.environ.get('DGW_PROFILE', '') not in ['', '0']:
+    enable([option.strip() for option in os.environ['DGW_PROFILE'].split(',')])
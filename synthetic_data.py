@@ -0,0 +1,211 @@
+import os
+import argparse
+import numpy as np
+from datetime import date
+from netCDF4 import Dataset
+import shapefile
+
+
+# File names used by dgw_calculation.py.
+gldas_file = 'GLDAS.A200201_201607.nc4'
+grace_files = {'CSR': 'GRCTellus.CSR.200204_201607.LND.RL05.DSTvSCS1409.nc',
+               'JPL': 'GRCTellus.JPL.200204_201607.LND.RL05_1.DSTvSCS1411.nc',
+               'GFZ': 'GRCTellus.GFZ.200204_201607.LND.RL05.DSTvSCS1409.nc'}
+factors_file = 'CLM4.SCALE_FACTOR.DS.G300KM.RL05.DSTvSCS1409.nc'
+
+# GLDAS components and their mean value [kg/m**2].
+gldas_variables = {'SoilMoi0_10cm_inst': 25, 'SoilMoi10_40cm_inst': 75,
+                   'SoilMoi40_100cm_inst': 150, 'SoilMoi100_200cm_inst': 250,
+                   'CanopInt_inst': 0.3}
+
+fill_value = -99999.0
+
+
+def land_mask(lat, lon):
+    """
+    Synthetic land mask. The study area in the Chaco-Pampean plain is always
+    land.
+
+    Arguments:
+    lat -- Array of latitudes in degrees.
+    lon -- Array of longitudes in degrees, from -180 to 180.
+
+    Returns:
+    land -- Boolean array (lat, lon) with True on land.
+    """
+
+    lon_grid, lat_grid = np.meshgrid(lon, lat)
+    land = np.sin(np.radians(2*lon_grid))*np.cos(np.radians(3*lat_grid)) > 0.2
+    land |= ((lon_grid > -70) & (lon_grid < -50) & (lat_grid > -45) & (lat_grid < -15))
+    land &= (lat_grid > -60) & (lat_grid < 84)
+
+    return land
+
+
+def signal(days, lat, lon, amplitude, seed):
+    """
+    Synthetic water storage: annual cycle with a phase that changes in space,
+    a trend and noise.
+
+    Arguments:
+    days -- Array (time,) with days since any reference.
+    lat, lon -- Arrays of latitudes and longitudes in degrees.
+    amplitude -- Amplitude of the annual cycle.
+    seed -- Seed of the random number generator.
+
+    Returns:
+    data -- Array (time, lat, lon), float32.
+    """
+
+    rng = np.random.default_rng(seed)
+    phase = np.radians(lon)[None, None, :] + np.radians(lat)[None, :, None]
+    t = days[:, None, None]/365.25
+
+    data = np.empty((len(days), len(lat), len(lon)), dtype = np.float32)
+    # Month by month, so the 0.25 degrees grids do not need float64 copies.
+    for i in range(len(days)):
+        data[i] = amplitude*(np.sin(2*np.pi*t[i] + phase) + 0.02*t[i]
+                             + 0.2*rng.standard_normal((len(lat), len(lon))))
+
+    return data
+
+
+def write_gldas(path, resolution, months, seed = 0):
+    """
+    Write a GLDAS-like netCDF file. Grid from -60 to 90 degrees of latitude
+    and -180 to 180 degrees of longitude, time in days since 2001-03-01.
+    """
+
+    lat = np.arange(-60 + resolution/2, 90, resolution)
+    lon = np.arange(-180 + resolution/2, 180, resolution)
+    days = np.asarray([(d - date(2001, 3, 1)).days for d in months], dtype = float)
+    land = land_mask(lat, lon)
+
+    with Dataset(path, 'w') as nc:
+        for dim, values in zip(['time', 'lat', 'lon'], [days, lat, lon]):
+            nc.createDimension(dim, len(values))
+            nc.createVariable(dim, 'f8', (dim,))[:] = values
+        nc.variables['time'].units = 'days since 2001-03-01 00:00:00'
+
+        for i, (name, mean) in enumerate(gldas_variables.items()):
+            data = mean + signal(days, lat, lon, 0.2*mean, seed + i)
+            data[:, ~land] = fill_value
+            var = nc.createVariable(name, 'f4', ('time', 'lat', 'lon'),
+                                    fill_value = fill_value)
+            var.units = 'kg m-2'
+            var[:] = data
+
+
+def write_grace(folder, resolution, months, missing, seed = 0):
+    """
+    Write GRACE-like netCDF files for CSR, JPL and GFZ, and the scale factors.
+    Grid from -90 to 90 degrees of latitude and 0 to 360 degrees of
+    longitude, time in days since 2002-01-01. Months in missing are filled
+    with fill values, as the masked months of the original files.
+    """
+
+    lat = np.arange(-90 + resolution/2, 90, resolution)
+    lon = np.arange(resolution/2, 360, resolution)
+    days = np.asarray([(d - date(2002, 1, 1)).days for d in months], dtype = float)
+    land = land_mask(lat, np.where(lon > 180, lon - 360, lon))
+
+    for i, (center, file) in enumerate(grace_files.items()):
+        data = signal(days, lat, lon, 10, seed + 10 + i)
+        data[:, ~land] = fill_value
+        data[missing] = fill_value
+        with Dataset(os.path.join(folder, file), 'w') as nc:
+            for dim, values in zip(['time', 'lat', 'lon'], [days, lat, lon]):
+                nc.createDimension(dim, len(values))
+                nc.createVariable(dim, 'f8', (dim,))[:] = values
+            nc.variables['time'].units = 'days since 2002-01-01 00:00:00'
+            var = nc.createVariable('lwe_thickness', 'f4', ('time', 'lat', 'lon'),
+                                    fill_value = fill_value)
+            var.units = 'cm'
+            var[:] = data
+
+    rng = np.random.default_rng(seed + 20)
+    factors = (1 + 0.3*rng.standard_normal((len(lat), len(lon)))).astype(np.float32)
+    factors[~land] = fill_value
+    with Dataset(os.path.join(folder, factors_file), 'w') as nc:
+        nc.createDimension('lat', len(lat))
+        nc.createDimension('lon', len(lon))
+        nc.createVariable('Latitude', 'f8', ('lat',))[:] = lat
+        nc.createVariable('Longitude', 'f8', ('lon',))[:] = lon
+        var = nc.createVariable('SCALE_FACTOR', 'f4', ('lat', 'lon'),
+                                fill_value = fill_value)
+        var[:] = factors
+
+
+def write_shapefiles(folder):
+    """
+    Write the shapefiles used by the scripts: a polygon with a hole for the
+    area of interest (loess_holes.shp) and a few provinces (provinces.shp).
+    Rings are clockwise and holes counterclockwise.
+    """
+
+    with shapefile.Writer(os.path.join(folder, 'loess_holes'),
+                          shapeType = shapefile.POLYGON) as w:
+        w.field('name', 'C')
+        w.poly([[(-66, -38), (-66, -26), (-57, -26), (-57, -38), (-66, -38)],
+                [(-63, -33), (-61, -33), (-61, -31), (-63, -31), (-63, -33)]])
+        w.record('loess')
+
+    with shapefile.Writer(os.path.join(folder, 'provinces'),
+                          shapeType = shapefile.POLYGON) as w:
+        w.field('name', 'C')
+        for i, lat_max in enumerate(range(-22, -55, -6)):
+            w.poly([[(-70, lat_max - 6), (-70, lat_max), (-53, lat_max),
+                     (-53, lat_max - 6), (-70, lat_max - 6)]])
+            w.record('province {}'.format(i))
+
+
+def write_synthetic(folder, resolution = 1, years = 15, seed = 0):
+    """
+    Write a synthetic data set with the variables, layouts and fill values
+    expected by dgw_calculation.py: ./data with GLDAS, GRACE and scale factor
+    netCDF files and ./shapefiles with the polygon and the provinces.
+
+    Arguments:
+    folder -- Folder where the data set is written.
+    resolution -- Grid resolution in degrees (1, 0.5, 0.25, etc.).
+    years -- Length of the GRACE record in years.
+    seed -- Seed of the random number generator.
+
+    Returns:
+    missing -- Boolean array with True for the masked GRACE months.
+    """
+
+    os.makedirs(os.path.join(folder, 'data'), exist_ok = True)
+    os.makedirs(os.path.join(folder, 'shapefiles'), exist_ok = True)
+
+    # GRACE starts in April 2002 with mid-month dates. About one month in ten
+    # has no solution, and a few more are masked.
+    rng = np.random.default_rng(seed)
+    n_months = 12*years
+    grace_months = [date(2002 + (3 + i)//12, (3 + i)%12 + 1, 16) for i in range(n_months)]
+    kept = np.ones(n_months, dtype = bool)
+    kept[rng.choice(np.arange(1, n_months - 1), n_months//10, replace = False)] = False
+    grace_months = [d for d, k in zip(grace_months, kept) if k]
+    missing = np.zeros(len(grace_months), dtype = bool)
+    missing[rng.choice(np.arange(1, len(grace_months) - 1), max(1, n_months//40),
+                       replace = False)] = True
+
+    # GLDAS starts in January 2002 and ends after the last GRACE month.
+    gldas_months = [date(2002 + i//12, i%12 + 1, 1) for i in range(n_months + 6)]
+
+    write_gldas(os.path.join(folder, 'data', gldas_file), resolution, gldas_months, seed)
+    write_grace(os.path.join(folder, 'data'), resolution, grace_months, missing, seed)
+    write_shapefiles(os.path.join(folder, 'shapefiles'))
+
+    return missing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Write synthetic GRACE and GLDAS data.')
+    parser.add_argument('folder')
+    parser.add_argument('--resolution', type = float, default = 1)
+    parser.add_argument('--years', type = int, default = 15)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    write_synthetic(args.folder, args.resolution, args.years, args.seed)